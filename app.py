@@ -1,16 +1,37 @@
-from flask import Flask, render_template, request, jsonify, send_file, Response, stream_with_context
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
+from werkzeug.wsgi import wrap_file
 import yt_dlp
 from yt_dlp import utils as yt_dlp_utils
+from yt_dlp.networking import Request as YtdlpRequest
+from yt_dlp.networking.exceptions import RequestError as YtdlpRequestError
+from yt_dlp.cookies import YoutubeDLCookieJar
 import os
 import json
 from pathlib import Path
 import threading
 import time
 import sys
-import io
 import tempfile
 import shutil
-from contextlib import redirect_stderr
+import fcntl
+import hashlib
+import mimetypes
+import subprocess
+import heapq
+import itertools
+import multiprocessing
+import cProfile
+import random
+import copy
+import secrets
+import hmac
+import base64
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+import sqlite3
+import re
+from urllib.parse import urlparse, parse_qs, quote
+import unicodedata
 
 app = Flask(__name__)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
@@ -18,22 +39,2022 @@ app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 # Create downloads directory if it doesn't exist
 DOWNLOADS_DIR = Path('downloads')
 DOWNLOADS_DIR.mkdir(exist_ok=True)
+# /api/downloads is served from an index of DOWNLOADS_DIR. Jobs add their files as they finish;
+# a scan (at most this often, seconds, across all workers) catches files added or removed by hand.
+DOWNLOADS_SCAN_INTERVAL = int(os.environ.get('DOWNLOADS_SCAN_INTERVAL', 300))
+# Page size of /api/downloads (default / maximum)
+DOWNLOADS_PAGE_SIZE = 100
+DOWNLOADS_PAGE_SIZE_MAX = 1000
 
-# Store download progress
+# Store download progress - the state database holds it for all workers. This dict keeps this
+# worker's active downloads, so progress-hook updates can be coalesced before they are written.
 download_status = {}
+# Guards download_status; notified on every change so progress streams in this worker don't poll
+download_status_changed = threading.Condition()
+# Progress-only updates are written at most this often (seconds); status changes immediately
+DOWNLOAD_STATUS_FLUSH_INTERVAL = 0.5
+# How often progress streams look for updates made by other workers (seconds)
+DOWNLOAD_STATUS_POLL_INTERVAL = 0.5
+# Finished/abandoned statuses are dropped after this long without updates, and only this many are kept
+DOWNLOAD_STATUS_TTL = int(os.environ.get('DOWNLOAD_STATUS_TTL', 3600))
+DOWNLOAD_STATUS_MAX_ENTRIES = int(os.environ.get('DOWNLOAD_STATUS_MAX_ENTRIES', 10000))
 
-def get_video_info(url):
-    """Extract video information without downloading"""
-    cookies_file = Path('cookies.txt')
-    has_cookies = cookies_file.exists()
+# Background download jobs (/api/jobs): worker threads and how many jobs may wait for one
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_LIMIT = int(os.environ.get('JOB_QUEUE_LIMIT', 20))
+# Longest a single progress event stream stays open (clients reconnect after this)
+JOB_EVENTS_MAX_DURATION = 600
+
+# Batch / playlist requests (/api/batch): most videos per request, metadata lookups run in
+# parallel, and downloads of batch entries running at once (the rest wait in their own queue)
+BATCH_MAX_ENTRIES = int(os.environ.get('BATCH_MAX_ENTRIES', 200))
+BATCH_INFO_WORKERS = int(os.environ.get('BATCH_INFO_WORKERS', 4))
+BATCH_DOWNLOAD_WORKERS = int(os.environ.get('BATCH_DOWNLOAD_WORKERS', 2))
+BATCH_QUEUE_LIMIT = int(os.environ.get('BATCH_QUEUE_LIMIT', 500))
+
+# FFmpeg post-processing runs in a process pool of this many workers per gunicorn worker.
+# Defaults to the available cores split between gunicorn workers (WEB_CONCURRENCY).
+FFMPEG_WORKERS = int(os.environ.get('FFMPEG_WORKERS', 0)) or max(
+    1, len(os.sched_getaffinity(0)) // max(int(os.environ.get('WEB_CONCURRENCY', 1)), 1))
+
+# Idle YoutubeDL instances kept per option set (per client config) for reuse by later requests
+YDL_POOL_SIZE = int(os.environ.get('YDL_POOL_SIZE', 4))
+
+# Shared state database - one SQLite file (WAL mode) so all gunicorn workers see the same caches
+STATE_DB = Path(os.environ.get('STATE_DB', Path(tempfile.gettempdir()) / 'yt-downloader-state.sqlite3'))
+
+# Metadata cache for /api/info (seconds / max number of videos kept)
+INFO_CACHE_TTL = int(os.environ.get('INFO_CACHE_TTL', 3600))
+INFO_CACHE_MAX_ENTRIES = int(os.environ.get('INFO_CACHE_MAX_ENTRIES', 5000))
+
+# Extraction tokens let /api/download reuse the yt-dlp result of /api/info
+EXTRACTION_TOKEN_TTL = int(os.environ.get('EXTRACTION_TOKEN_TTL', 1800))
+# Re-extract if the signed stream URLs expire sooner than this (seconds)
+STREAM_URL_MIN_LIFETIME = 300
+
+# Signed /api/download/<token> links for native browser downloads (seconds until they expire)
+DOWNLOAD_TOKEN_TTL = int(os.environ.get('DOWNLOAD_TOKEN_TTL', 600))
+# HMAC key for those links; generated and kept in the state DB if unset
+DOWNLOAD_TOKEN_SECRET = os.environ.get('DOWNLOAD_TOKEN_SECRET')
+
+# Cookie account pool: every *.txt in COOKIES_DIR (plus ./cookies.txt) is one YouTube session
+COOKIES_DIR = Path(os.environ.get('COOKIES_DIR', 'cookies'))
+# A rate-limited account rests this long (seconds), doubling per consecutive throttle up to COOKIE_COOLDOWN_MAX
+COOKIE_COOLDOWN = int(os.environ.get('COOKIE_COOLDOWN', 600))
+COOKIE_COOLDOWN_MAX = 6 * 3600
+# How often (seconds) COOKIES_DIR is rescanned, and refreshed cookies are written back to their file
+COOKIE_RESCAN_INTERVAL = 30
+COOKIE_SAVE_INTERVAL = 60
+
+# Hedged extraction: how many player clients may run at once, and how long (seconds)
+# a running attempt may go unanswered before the next one starts. HEDGE_FANOUT=1 tries them one by one.
+HEDGE_FANOUT = int(os.environ.get('HEDGE_FANOUT', 2))
+HEDGE_DELAY = float(os.environ.get('HEDGE_DELAY', 2.5))
+
+# Known-dead videos (removed, terminated, ...) are answered from this cache for a while (seconds)
+NEGATIVE_CACHE_TTL = int(os.environ.get('NEGATIVE_CACHE_TTL', 300))
+
+# Client configs are reordered by recent success rate; older outcomes count half after this (seconds)
+CLIENT_STATS_HALF_LIFE = int(os.environ.get('CLIENT_STATS_HALF_LIFE', 1800))
+
+# Pass-through streaming: read size per chunk and size of each ranged origin request
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_RANGE_SIZE = 10 * 1024 * 1024
+
+# Download bandwidth shared by all active downloads of all workers (bytes/s, 0 = unlimited)
+BANDWIDTH_LIMIT = int(os.environ.get('BANDWIDTH_LIMIT', 0))
+# Parallel fragment fetches (DASH/HLS) split across active downloads, at most FRAGMENTS_PER_JOB_MAX each
+FRAGMENT_BUDGET = int(os.environ.get('FRAGMENT_BUDGET', 16))
+FRAGMENTS_PER_JOB_MAX = 8
+# yt-dlp fetches http formats in ranges of this size too
+HTTP_CHUNK_SIZE = STREAM_RANGE_SIZE
+# A download's share halves at this much left to fetch - short and nearly finished ones go first
+BANDWIDTH_SHORT_JOB_BYTES = 64 * 1024 * 1024
+# Allocations are recomputed this often (seconds); downloads silent for BANDWIDTH_JOB_STALE no longer count
+BANDWIDTH_UPDATE_INTERVAL = 1
+BANDWIDTH_JOB_STALE = 60
+
+# Finished downloads are kept here (content-addressed) and shared by identical requests
+RESULT_CACHE_DIR = Path(os.environ.get('RESULT_CACHE_DIR', Path(tempfile.gettempdir()) / 'yt-downloader-cache'))
+RESULT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 2 * 1024 * 1024 * 1024))
+# How long a request waits for an identical in-progress download to produce data
+RESULT_FOLLOW_TIMEOUT = 600
+# MP3 conversion applied to audio downloads
+AUDIO_POSTPROCESSOR = {
+    'key': 'FFmpegExtractAudio',
+    'preferredcodec': 'mp3',
+    'preferredquality': '192',
+}
+# Audio formats a client can ask for: format selector preferring a source that needs no
+# conversion, and the postprocessor producing the file (None = send the source stream as is)
+AUDIO_FORMATS = {
+    'mp3': ('bestaudio/best', AUDIO_POSTPROCESSOR),
+    'm4a': ('bestaudio[ext=m4a]/bestaudio/best', {'key': 'FFmpegExtractAudio', 'preferredcodec': 'm4a'}),
+    'opus': ('bestaudio[acodec=opus]/bestaudio/best', {'key': 'FFmpegExtractAudio', 'preferredcodec': 'opus'}),
+    'original': ('bestaudio/best', None),
+}
+# Values of a download request's "format" and (video) "quality" options
+DOWNLOAD_FORMATS = ('video', 'audio')
+VIDEO_QUALITIES = ('best', '720p', '480p', '360p')
+# Container each audio codec is delivered in
+AUDIO_CONTAINERS = {'mp3': 'mp3', 'm4a': 'm4a', 'opus': 'opus'}
+# ffmpeg output options for streaming transcodes (formats that can be written to a pipe)
+TRANSCODE_ARGS = {
+    'mp3': ['-codec:a', 'libmp3lame', '-f', 'mp3'],
+    'm4a': ['-codec:a', 'aac', '-f', 'ipod', '-movflags', 'frag_keyframe+empty_moov'],
+    'opus': ['-codec:a', 'libopus', '-f', 'opus'],
+}
+# Source containers ffmpeg can decode from a pipe while they download
+STREAMABLE_CONTAINERS = ('webm', 'ogg', 'opus', 'mp3')
+# Name the user's browser saves a download as
+DOWNLOAD_NAME_TEMPLATE = '%(title)s.%(ext)s'
+# Prefix of temp directories used for conversions (counted as temp-disk usage in /metrics)
+TEMP_DIR_PREFIX = 'ytdl-'
+
+# Disk budget for downloads in progress (temp dirs and unfinished cache files), shared by all workers
+TEMP_QUOTA_BYTES = int(os.environ.get('TEMP_QUOTA_BYTES', 4 * 1024 * 1024 * 1024))
+# Reserved for a download whose size yt-dlp doesn't know
+TEMP_DEFAULT_RESERVATION = 256 * 1024 * 1024
+# Temp dirs older than this (seconds) are removed even if the process that made them still runs
+TEMP_ORPHAN_AGE = int(os.environ.get('TEMP_ORPHAN_AGE', 3600))
+TEMP_REAP_INTERVAL = 60
+
+# Histogram buckets of the /metrics histograms, in the metric's unit
+METRIC_BUCKETS = {
+    'ytdl_extraction_seconds': (0.5, 1, 2, 5, 10, 20, 30, 60),
+    'ytdl_attempt_seconds': (0.5, 1, 2, 5, 10, 30, 60, 120, 300),
+    'ytdl_download_attempts': (1, 2, 3, 5, 8, 13),
+    'ytdl_ffmpeg_wait_seconds': (0.1, 0.5, 1, 5, 15, 60, 300),
+    'ytdl_postprocess_seconds': (0.5, 1, 2, 5, 10, 30, 60, 300),
+    'ytdl_response_ttfb_seconds': (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+    'ytdl_response_seconds': (0.1, 0.5, 1, 5, 15, 60, 300, 900),
+    'ytdl_response_bytes_per_second': (2 ** 16, 2 ** 18, 2 ** 20, 2 ** 22, 2 ** 24, 2 ** 26),
+}
+METRIC_HELP = {
+    'ytdl_extraction_seconds': 'Metadata extraction per request, all client attempts included',
+    'ytdl_attempt_seconds': 'One player client / format attempt',
+    'ytdl_download_attempts': 'Client / format attempts a download request needed',
+    'ytdl_ffmpeg_wait_seconds': 'Time FFmpeg work waited for a free slot',
+    'ytdl_postprocess_seconds': 'FFmpeg post-processing / streaming transcode run time',
+    'ytdl_response_ttfb_seconds': 'Time from request start to the first response body byte',
+    'ytdl_response_seconds': 'Time from request start until the response body was sent',
+    'ytdl_response_bytes_per_second': 'Response body throughput of streamed responses',
+}
+
+# Optional profiling: requests are run under cProfile and written to PROFILE_DIR as .prof files.
+# Off unless PROFILE_DIR is set; then a PROFILE_SAMPLE_RATE fraction of requests is profiled,
+# plus requests sending an X-Profile header equal to PROFILE_TOKEN.
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+
+STATE_DB_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS info_cache (
+        key TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        created REAL NOT NULL,
+        accessed REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS info_cache_accessed ON info_cache (accessed)',
+    '''CREATE TABLE IF NOT EXISTS counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )''',
+    '''CREATE TABLE IF NOT EXISTS histograms (
+        name TEXT NOT NULL,
+        labels TEXT NOT NULL,
+        bucket INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        total REAL NOT NULL,
+        PRIMARY KEY (name, labels, bucket)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS extractions (
+        token TEXT PRIMARY KEY,
+        cache_key TEXT NOT NULL,
+        config TEXT NOT NULL,
+        info TEXT NOT NULL,
+        created REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS extractions_key ON extractions (cache_key, created)',
+    '''CREATE TABLE IF NOT EXISTS result_cache (
+        key TEXT PRIMARY KEY,
+        filename TEXT NOT NULL,
+        ext TEXT,
+        size INTEGER,
+        complete INTEGER NOT NULL DEFAULT 0,
+        created REAL NOT NULL,
+        accessed REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS result_cache_accessed ON result_cache (complete, accessed)',
+    '''CREATE TABLE IF NOT EXISTS client_stats (
+        cookie_mode TEXT NOT NULL,
+        config TEXT NOT NULL,
+        successes REAL NOT NULL,
+        failures REAL NOT NULL,
+        latency REAL,
+        updated REAL NOT NULL,
+        PRIMARY KEY (cookie_mode, config)
+    )''',
+    '''CREATE TABLE IF NOT EXISTS download_status (
+        key TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        updated REAL NOT NULL
+    )''',
+    'CREATE INDEX IF NOT EXISTS download_status_updated ON download_status (updated)',
+    '''CREATE TABLE IF NOT EXISTS negative_cache (
+        key TEXT PRIMARY KEY,
+        message TEXT NOT NULL,
+        created REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS result_aliases (
+        alias TEXT PRIMARY KEY,
+        key TEXT NOT NULL,
+        created REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS temp_reservations (
+        key TEXT PRIMARY KEY,
+        bytes INTEGER NOT NULL,
+        pid INTEGER NOT NULL,
+        created REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS cookie_accounts (
+        name TEXT PRIMARY KEY,
+        successes REAL NOT NULL,
+        failures REAL NOT NULL,
+        strikes INTEGER NOT NULL DEFAULT 0,
+        cooldown_until REAL NOT NULL DEFAULT 0,
+        updated REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS bandwidth_jobs (
+        id TEXT PRIMARY KEY,
+        route TEXT NOT NULL,
+        label TEXT NOT NULL,
+        total INTEGER,
+        downloaded INTEGER NOT NULL,
+        started REAL NOT NULL,
+        updated REAL NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS downloads_index (
+        name TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        video_id TEXT,
+        format TEXT
+    )''',
+    'CREATE INDEX IF NOT EXISTS downloads_index_mtime ON downloads_index (mtime_ns, name)',
+    'CREATE INDEX IF NOT EXISTS downloads_index_size ON downloads_index (size, name)',
+    '''CREATE TABLE IF NOT EXISTS settings (
+        name TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    )''',
+]
+
+_db_local = threading.local()
+
+def get_db():
+    """Per-thread connection to the shared state database"""
+    conn = getattr(_db_local, 'conn', None)
+    # A connection inherited through fork (gunicorn --preload) must not be reused
+    if conn is None or getattr(_db_local, 'pid', None) != os.getpid():
+        conn = sqlite3.connect(str(STATE_DB), timeout=10, isolation_level=None, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        for statement in STATE_DB_SCHEMA:
+            conn.execute(statement)
+        _db_local.conn = conn
+        _db_local.pid = os.getpid()
+    return conn
+
+def bump_counter(name, amount=1):
+    """Increment a counter shared by all workers"""
+    get_db().execute(
+        'INSERT INTO counters (name, value) VALUES (?, ?) '
+        'ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+        (name, amount)
+    )
+
+def read_counters(prefix):
+    """Return all shared counters whose name starts with prefix"""
+    rows = get_db().execute('SELECT name, value FROM counters WHERE name LIKE ?', (prefix + '%',))
+    return {name[len(prefix):]: value for name, value in rows}
+
+def metric_labels(**labels):
+    """Prometheus label set text, e.g. client="web",outcome="ok" (sorted by name)"""
+    return ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', ' '))
+        for name, value in sorted(labels.items())
+    )
+
+def observe(name, value, **labels):
+    """Record one observation of a METRIC_BUCKETS histogram (shared by all workers)"""
+    buckets = METRIC_BUCKETS[name]
+    bucket = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+    get_db().execute(
+        'INSERT INTO histograms (name, labels, bucket, count, total) VALUES (?, ?, ?, 1, ?) '
+        'ON CONFLICT(name, labels, bucket) DO UPDATE SET count = count + 1, total = total + excluded.total',
+        (name, metric_labels(**labels), bucket, value)
+    )
+
+def client_label(config):
+    """Short name of a player client config for metric labels"""
+    return ','.join(config.get('player_client') or []) or 'default'
+
+YOUTUBE_ID_RE = re.compile(r'^[A-Za-z0-9_-]{11}$')
+
+def extract_video_id(url):
+    """Normalize any YouTube URL form (watch, youtu.be, shorts, embed, live) to its video ID"""
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or '').lower()
+    for prefix in ('www.', 'm.', 'music.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    
+    candidate = ''
+    if host == 'youtu.be':
+        candidate = parsed.path.strip('/').split('/')[0]
+    elif host in ('youtube.com', 'youtube-nocookie.com'):
+        if parsed.path.rstrip('/') == '/watch':
+            candidate = parse_qs(parsed.query).get('v', [''])[0]
+        else:
+            parts = parsed.path.strip('/').split('/')
+            if len(parts) >= 2 and parts[0] in ('shorts', 'embed', 'live', 'v', 'e'):
+                candidate = parts[1]
+    
+    return candidate if YOUTUBE_ID_RE.match(candidate) else None
+
+def info_cache_key(url):
+    """Cache key for a URL - the video ID, so every URL form of one video shares an entry"""
+    video_id = extract_video_id(url)
+    if video_id:
+        return f'yt:{video_id}'
+    # Not a recognisable YouTube URL - fall back to the raw URL
+    return f'url:{url.strip()}'
+
+def info_cache_get(key):
+    """Return cached video info, or None if missing or expired"""
+    db = get_db()
+    now = time.time()
+    row = db.execute('SELECT data, created FROM info_cache WHERE key = ?', (key,)).fetchone()
+    if row and now - row[1] < INFO_CACHE_TTL:
+        db.execute('UPDATE info_cache SET accessed = ? WHERE key = ?', (now, key))
+        bump_counter('info_cache.hits')
+        return json.loads(row[0])
+    if row:
+        db.execute('DELETE FROM info_cache WHERE key = ?', (key,))
+    bump_counter('info_cache.misses')
+    return None
+
+def info_cache_put(key, info):
+    """Store video info and evict expired / least recently used entries"""
+    db = get_db()
+    now = time.time()
+    db.execute(
+        'INSERT OR REPLACE INTO info_cache (key, data, created, accessed) VALUES (?, ?, ?, ?)',
+        (key, json.dumps(info), now, now)
+    )
+    db.execute('DELETE FROM info_cache WHERE created < ?', (now - INFO_CACHE_TTL,))
+    db.execute(
+        'DELETE FROM info_cache WHERE key IN '
+        '(SELECT key FROM info_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)',
+        (INFO_CACHE_MAX_ENTRIES,)
+    )
+
+def info_cache_stats():
+    """Hit/miss counters and size of the metadata cache"""
+    counters = read_counters('info_cache.')
+    hits = counters.get('hits', 0)
+    misses = counters.get('misses', 0)
+    entries = get_db().execute('SELECT COUNT(*) FROM info_cache').fetchone()[0]
+    return {
+        'entries': entries,
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': round(hits / (hits + misses), 4) if hits + misses else 0.0,
+        'ttl': INFO_CACHE_TTL,
+        'max_entries': INFO_CACHE_MAX_ENTRIES,
+    }
+
+def uses_cookies(config):
+    return not (isinstance(config, dict) and config.get('no_cookies'))
+
+def apply_client_config(ydl_opts, config, has_cookies, cookies_file):
+    """Add the player client extractor args and cookie file for one fallback config"""
+    if config:
+        # Handle special case: android_vr without cookies
+        if isinstance(config, dict) and config.get('no_cookies'):
+            # Don't use cookies for this config
+            player_client = config['player_client']
+            ydl_opts['extractor_args'] = {'youtube': {'player_client': player_client}}
+        else:
+            ydl_opts['extractor_args'] = {'youtube': config}
+    
+    # Only use cookies if not explicitly disabled for this config
+    if has_cookies and uses_cookies(config):
+        ydl_opts['cookiefile'] = str(cookies_file)
+    return ydl_opts
+
+def client_config_key(config):
+    return json.dumps(config, sort_keys=True)
+
+def _decay(value, updated, now):
+    """Exponentially age a counter so old outcomes stop dominating"""
+    return value * 0.5 ** (max(now - updated, 0) / CLIENT_STATS_HALF_LIFE)
+
+ERROR_PERMANENT = 'permanent'
+ERROR_AUTH_REQUIRED = 'auth_required'
+ERROR_RATE_LIMITED = 'rate_limited'
+ERROR_FORMAT_MISSING = 'format_missing'
+ERROR_TRANSIENT = 'transient'
+
+# Checked in order (lowercase substrings of yt-dlp error messages) - the first match wins
+ERROR_PATTERNS = [
+    (ERROR_RATE_LIMITED, ('not a bot', 'http error 429', 'too many requests', 'rate-limit', 'rate limit', 'try again later')),
+    (ERROR_FORMAT_MISSING, ('format is not available', 'requested format', 'only images are available', 'storyboard', 'merging')),
+    # Media fetches failing after extraction (e.g. a stream URL answering 404) - the video itself exists
+    (ERROR_TRANSIENT, ('unable to download video data', 'fragment')),
+    # Before the permanent patterns: "Video unavailable. This video is private" may still open
+    # for a cookie-bearing client, so it mustn't end the chain on a cookieless attempt
+    (ERROR_AUTH_REQUIRED, (
+        'confirm your age', 'age-restricted', 'inappropriate for some users', 'members-only',
+        'join this channel', 'requires payment', 'login required', 'sign in', 'cookies',
+        'private video', 'video is private',
+    )),
+    (ERROR_PERMANENT, (
+        'video unavailable', 'video is unavailable', 'has been removed',
+        'has been terminated', 'no longer available', 'does not exist', 'copyright', 'http error 404',
+        'http error 410', 'unsupported url', 'is not a valid url', 'incomplete youtube id',
+        'not available in your country', 'not made this video available',
+    )),
+]
+
+def classify_error(error):
+    """Map a yt-dlp error (or its message) to one of the ERROR_* categories"""
+    message = str(error).lower()
+    for category, patterns in ERROR_PATTERNS:
+        if any(pattern in message for pattern in patterns):
+            return category
+    # Timeouts, connection resets, 5xx ... - worth retrying with another client
+    return ERROR_TRANSIENT
+
+def is_permanent_error(error):
+    """True if no other client or format can fix this - the fallback chain should stop"""
+    return classify_error(error) == ERROR_PERMANENT
+
+def negative_cache_get(key):
+    """Known-dead video: the error returned last time, or None"""
+    row = get_db().execute(
+        'SELECT message FROM negative_cache WHERE key = ? AND created >= ?',
+        (key, time.time() - NEGATIVE_CACHE_TTL)
+    ).fetchone()
+    if row:
+        bump_counter('negative_cache.hits')
+        return row[0]
+    return None
+
+def negative_cache_put(key, message):
+    now = time.time()
+    db = get_db()
+    db.execute(
+        'INSERT OR REPLACE INTO negative_cache (key, message, created) VALUES (?, ?, ?)',
+        (key, message, now)
+    )
+    db.execute('DELETE FROM negative_cache WHERE created < ?', (now - NEGATIVE_CACHE_TTL,))
+
+def permanent_error_summary(errors):
+    """User-facing reason a video can't be fetched at all, or None if the errors aren't permanent"""
+    permanent = [e for e in errors if is_permanent_error(e)]
+    if not permanent:
+        return None
+    first_error = permanent[0][:100] + ('...' if len(permanent[0]) > 100 else '')
+    return f'Video is unavailable, private or has been removed. Error: {first_error}'
+
+def record_client_result(cookies_file, config, ok, latency=None, error=None):
+    """Feed one attempt's outcome into the per-client success/latency tracker shared by all workers,
+    and into its cookie account's health if it used one"""
+    if cookies_file and uses_cookies(config):
+        record_account_result(cookies_file, ok, error)
+    db = get_db()
+    now = time.time()
+    mode = 'cookies' if cookies_file else 'no_cookies'
+    key = client_config_key(config)
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        row = db.execute(
+            'SELECT successes, failures, latency, updated FROM client_stats WHERE cookie_mode = ? AND config = ?',
+            (mode, key)
+        ).fetchone()
+        successes, failures, avg_latency = 0.0, 0.0, None
+        if row:
+            successes, failures = _decay(row[0], row[3], now), _decay(row[1], row[3], now)
+            avg_latency = row[2]
+        if ok:
+            successes += 1
+            if latency is not None:
+                avg_latency = latency if avg_latency is None else 0.7 * avg_latency + 0.3 * latency
+        else:
+            failures += 1
+        db.execute(
+            'INSERT OR REPLACE INTO client_stats (cookie_mode, config, successes, failures, latency, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (mode, key, successes, failures, avg_latency, now)
+        )
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+
+def record_client_failure(cookies_file, config, error):
+    """Count a failed attempt against its client - unless the video or format was the problem"""
+    if classify_error(error) not in (ERROR_PERMANENT, ERROR_FORMAT_MISSING):
+        record_client_result(cookies_file, config, False, error=error)
+
+def client_stats(has_cookies):
+    """Decayed success rate and average latency per client config: {config key: (rate, latency)}"""
+    now = time.time()
+    stats = {}
+    for key, successes, failures, latency, updated in get_db().execute(
+        'SELECT config, successes, failures, latency, updated FROM client_stats WHERE cookie_mode = ?',
+        ('cookies' if has_cookies else 'no_cookies',)
+    ):
+        successes, failures = _decay(successes, updated, now), _decay(failures, updated, now)
+        # Laplace prior: an unknown (or long-forgotten) client scores 0.5
+        stats[key] = ((successes + 1) / (successes + failures + 2), latency)
+    return stats
+
+def order_client_configs(client_configs, has_cookies):
+    """Reorder fallback configs so the one most likely to succeed (then the fastest) goes first.
+    
+    The static order breaks ties, so it still applies until there are stats. Because counts
+    decay, a client that failed a while ago drifts back to the prior and gets tried again.
+    """
+    stats = client_stats(has_cookies)
+    
+    def sort_key(item):
+        index, config = item
+        rate, latency = stats.get(client_config_key(config), (0.5, None))
+        return (-round(rate * 20), latency if latency is not None else float('inf'), index)
+    
+    return [config for _, config in sorted(enumerate(client_configs), key=sort_key)]
+
+class PooledCookieJar(YoutubeDLCookieJar):
+    """One account's parsed cookies, shared by every YoutubeDL in this process that uses it.
+    YoutubeDL saves its jar on close(); here that becomes an occasional rewrite of the file."""
+    
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.load()
+        self.mtime = os.stat(filename).st_mtime
+        self.saved = time.time()
+        self.save_lock = threading.Lock()
+    
+    def save(self, filename=None, *args, **kwargs):
+        if filename is not None:
+            return super().save(filename, *args, **kwargs)
+        with self.save_lock:
+            if time.time() - self.saved < COOKIE_SAVE_INTERVAL:
+                return
+            self.saved = time.time()
+            try:
+                if os.stat(self.filename).st_mtime != self.mtime:
+                    # Edited by someone else since we read it - theirs wins
+                    return
+                super().save(None, *args, **kwargs)
+                # Our own write - not a reason to parse the file again
+                self.mtime = os.stat(self.filename).st_mtime
+            except OSError:
+                # Read-only cookie files still work for reading
+                pass
+
+# Account cookie files and their parsed jars, per process
+cookie_pool = {'scanned': 0, 'accounts': [], 'jars': {}}
+cookie_pool_lock = threading.Lock()
+
+def cookie_accounts():
+    """Cookie files of the account pool, rescanned every COOKIE_RESCAN_INTERVAL seconds"""
+    with cookie_pool_lock:
+        if time.time() - cookie_pool['scanned'] > COOKIE_RESCAN_INTERVAL:
+            accounts = sorted(COOKIES_DIR.glob('*.txt')) if COOKIES_DIR.is_dir() else []
+            if Path('cookies.txt').is_file():
+                accounts.append(Path('cookies.txt'))
+            cookie_pool['accounts'] = accounts
+            cookie_pool['scanned'] = time.time()
+            # Files that were removed or replaced are parsed again on next use
+            for name, jar in list(cookie_pool['jars'].items()):
+                try:
+                    changed = os.stat(name).st_mtime != jar.mtime
+                except FileNotFoundError:
+                    changed = True
+                if changed:
+                    del cookie_pool['jars'][name]
+        return cookie_pool['accounts']
+
+def cookie_jar(cookies_file):
+    """Parsed jar of an account's cookie file - loaded once, not on every attempt"""
+    name = str(cookies_file)
+    with cookie_pool_lock:
+        jar = cookie_pool['jars'].get(name)
+    if jar is None:
+        jar = PooledCookieJar(name)
+        with cookie_pool_lock:
+            jar = cookie_pool['jars'].setdefault(name, jar)
+    return jar
+
+def new_ydl(ydl_opts):
+    """YoutubeDL for ydl_opts, its cookie file (if any) already parsed"""
+    ydl = yt_dlp.YoutubeDL(ydl_opts)
+    if ydl.params.get('cookiefile'):
+        try:
+            # YoutubeDL.cookiejar is a cached property - seed it instead of parsing the file again
+            ydl.__dict__['cookiejar'] = cookie_jar(ydl.params['cookiefile'])
+        except OSError:
+            # Gone since the last scan - yt-dlp copes with a missing cookie file itself
+            pass
+    return ydl
+
+def cookie_jar_current(ydl):
+    """False if ydl's cookie file was changed (or removed) after ydl got its jar"""
+    cookiefile = ydl.params.get('cookiefile')
+    if not cookiefile:
+        return True
+    try:
+        return ydl.__dict__.get('cookiejar') is cookie_jar(cookiefile)
+    except OSError:
+        return False
+
+def pick_cookie_account():
+    """Cookie file for the next request: a random account that isn't cooling down, weighted by
+    its recent success rate. None if there are no accounts, or all of them are resting."""
+    accounts = cookie_accounts()
+    if not accounts:
+        return None
+    now = time.time()
+    health = {
+        name: row for name, *row in get_db().execute(
+            'SELECT name, successes, failures, cooldown_until, updated FROM cookie_accounts'
+        )
+    }
+    candidates, weights = [], []
+    for account in accounts:
+        row = health.get(str(account))
+        if row and row[2] > now:
+            continue
+        successes, failures = (_decay(row[0], row[3], now), _decay(row[1], row[3], now)) if row else (0.0, 0.0)
+        candidates.append(account)
+        weights.append((successes + 1) / (successes + failures + 2))
+    if not candidates:
+        bump_counter('cookies.all_cooling')
+        return None
+    return random.choices(candidates, weights)[0]
+
+def record_account_result(cookies_file, ok, error=None):
+    """Track an account's success rate; a rate-limit error sends it into a cooldown that grows
+    with each consecutive throttle"""
+    db = get_db()
+    now = time.time()
+    name = str(cookies_file)
+    throttled = False
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        row = db.execute(
+            'SELECT successes, failures, strikes, cooldown_until, updated FROM cookie_accounts WHERE name = ?',
+            (name,)
+        ).fetchone()
+        successes, failures, strikes, cooldown_until = 0.0, 0.0, 0, 0
+        if row:
+            successes, failures = _decay(row[0], row[4], now), _decay(row[1], row[4], now)
+            strikes, cooldown_until = row[2], row[3]
+        if ok:
+            successes += 1
+            strikes = 0
+        else:
+            failures += 1
+            # Requests already in flight when it got throttled don't add strikes
+            if classify_error(error) == ERROR_RATE_LIMITED and cooldown_until <= now:
+                strikes += 1
+                cooldown_until = now + min(COOKIE_COOLDOWN * 2 ** (strikes - 1), COOKIE_COOLDOWN_MAX)
+                throttled = True
+        db.execute(
+            'INSERT OR REPLACE INTO cookie_accounts (name, successes, failures, strikes, cooldown_until, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (name, successes, failures, strikes, cooldown_until, now)
+        )
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    if throttled:
+        bump_counter('cookies.throttled')
+
+def cookie_account_stats():
+    """Health of every account in the pool"""
+    now = time.time()
+    rows = {
+        name: row for name, *row in get_db().execute(
+            'SELECT name, successes, failures, strikes, cooldown_until, updated FROM cookie_accounts'
+        )
+    }
+    accounts = []
+    for account in cookie_accounts():
+        successes, failures, strikes, cooldown_until, updated = rows.get(str(account), (0.0, 0.0, 0, 0, now))
+        successes, failures = _decay(successes, updated, now), _decay(failures, updated, now)
+        accounts.append({
+            'account': opaque_id(str(account)),
+            'success_rate': round((successes + 1) / (successes + failures + 2), 3),
+            'attempts': round(successes + failures, 1),
+            'throttles': strikes,
+            'cooldown_seconds': max(0, round(cooldown_until - now)),
+        })
+    return accounts
+
+def store_extraction(url, config, info):
+    """Keep a full extraction result so /api/download can skip extracting again. Returns its token."""
+    db = get_db()
+    now = time.time()
+    token = secrets.token_urlsafe(24)
+    db.execute(
+        'INSERT INTO extractions (token, cache_key, config, info, created) VALUES (?, ?, ?, ?, ?)',
+        (token, info_cache_key(url), json.dumps(config), json.dumps(info), now)
+    )
+    db.execute('DELETE FROM extractions WHERE created < ?', (now - EXTRACTION_TOKEN_TTL,))
+    return token
+
+def latest_extraction_token(cache_key):
+    """Token of the newest still-valid extraction for a video, if any"""
+    row = get_db().execute(
+        'SELECT token FROM extractions WHERE cache_key = ? AND created >= ? ORDER BY created DESC LIMIT 1',
+        (cache_key, time.time() - EXTRACTION_TOKEN_TTL)
+    ).fetchone()
+    return row[0] if row else None
+
+def stream_urls_expire_at(info):
+    """Earliest expiry (unix time) of the signed stream URLs in an info dict, or None"""
+    expiries = []
+    for fmt in info.get('formats') or []:
+        query = parse_qs(urlparse(fmt.get('url') or '').query)
+        if 'expire' in query:
+            try:
+                expiries.append(int(query['expire'][0]))
+            except ValueError:
+                pass
+        else:
+            # Some formats carry the expiry in the path (/expire/<ts>/)
+            match = re.search(r'/expire/(\d+)', fmt.get('url') or '')
+            if match:
+                expiries.append(int(match.group(1)))
+    return min(expiries) if expiries else None
+
+def load_extraction(token, url):
+    """Return {'config', 'info'} for a token issued by /api/info, or None if unknown, expired or stale"""
+    if not token:
+        return None
+    row = get_db().execute(
+        'SELECT cache_key, config, info, created FROM extractions WHERE token = ?', (token,)
+    ).fetchone()
+    if not row:
+        return None
+    cache_key, config, info, created = row
+    # Token must belong to the requested video
+    if cache_key != info_cache_key(url) or time.time() - created > EXTRACTION_TOKEN_TTL:
+        return None
+    info = json.loads(info)
+    expires_at = stream_urls_expire_at(info)
+    if expires_at is not None and expires_at < time.time() + STREAM_URL_MIN_LIFETIME:
+        return None
+    return {'config': json.loads(config), 'info': info}
+
+class PriorityGate:
+    """Admits up to `slots` holders at once; waiters go in by priority (lowest first, FIFO on ties)"""
+    
+    def __init__(self, slots):
+        self.slots = slots
+        self.active = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+        self.changed = threading.Condition()
+    
+    @contextmanager
+    def slot(self, priority):
+        with self.changed:
+            entry = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, entry)
+            while self.active >= self.slots or self.waiting[0] != entry:
+                self.changed.wait()
+            heapq.heappop(self.waiting)
+            self.active += 1
+            # The next waiter may fit in a remaining slot
+            self.changed.notify_all()
+        try:
+            yield
+        finally:
+            with self.changed:
+                self.active -= 1
+                self.changed.notify_all()
+    
+    def stats(self):
+        with self.changed:
+            return {'slots': self.slots, 'active': self.active, 'queued': len(self.waiting)}
+
+# CPU-bound ffmpeg work is admitted here - shortest media first, so a quick clip isn't stuck
+# behind an hour-long conversion - and runs in ffmpeg_pool (post-processing) or as a
+# streaming ffmpeg subprocess (lead_transcode)
+ffmpeg_gate = PriorityGate(FFMPEG_WORKERS)
+ffmpeg_pool = None
+ffmpeg_pool_lock = threading.Lock()
+
+def bandwidth_allocations():
+    """Share of BANDWIDTH_LIMIT and FRAGMENT_BUDGET of every active download in any worker.
+    Each is weighted 1 / (1 + remaining / BANDWIDTH_SHORT_JOB_BYTES)."""
+    rows = get_db().execute(
+        'SELECT id, route, label, total, downloaded, started FROM bandwidth_jobs WHERE updated > ? ORDER BY started',
+        (time.time() - BANDWIDTH_JOB_STALE,)
+    ).fetchall()
+    weights = {}
+    for job_id, _, _, total, downloaded, _ in rows:
+        # Unknown sizes count as a typical large download
+        remaining = max((total or TEMP_DEFAULT_RESERVATION) - downloaded, 0)
+        weights[job_id] = 1 / (1 + remaining / BANDWIDTH_SHORT_JOB_BYTES)
+    total_weight = sum(weights.values())
+    allocations = {}
+    for job_id, route, _, total, downloaded, started in rows:
+        share = weights[job_id] / total_weight
+        allocations[job_id] = {
+            'route': route,
+            'total': total,
+            'downloaded': downloaded,
+            'share': round(share, 3),
+            'rate': int(BANDWIDTH_LIMIT * share) if BANDWIDTH_LIMIT else None,
+            'fragments': max(1, min(FRAGMENTS_PER_JOB_MAX, int(FRAGMENT_BUDGET * share))),
+        }
+    return allocations
+
+class BandwidthJob:
+    """One active download's slice of the bandwidth budget, kept up to date as it progresses.
+    
+    yt-dlp downloads get it as concurrent_fragment_downloads / http_chunk_size / ratelimit
+    (ratelimit is re-read per block, so it follows changes mid-download); streams we proxy
+    ourselves are paced by transferred().
+    """
+    
+    def __init__(self, job_id, route, label, total=None):
+        self.id = job_id
+        self.route = route
+        self.label = label
+        self.total = total
+        self.downloaded = 0
+        self.started = time.time()
+        self.rate = None
+        self.fragments = 1
+        self.fragmented = False
+        self.params = []
+        self.finished = False
+        self.window_start, self.window_bytes = self.started, 0
+        self.refresh()
+    
+    def ydl_params(self):
+        ratelimit = self.rate
+        if ratelimit and self.fragmented:
+            # Every fragment connection is limited separately
+            ratelimit = max(ratelimit // self.fragments, 1)
+        return {'concurrent_fragment_downloads': self.fragments, 'http_chunk_size': HTTP_CHUNK_SIZE, 'ratelimit': ratelimit}
+    
+    def attach(self, ydl):
+        """Make ydl's downloads follow this allocation"""
+        ydl.params.update(self.ydl_params())
+        self.params.append(ydl.params)
+        ydl.add_progress_hook(self.progress_hook)
+    
+    def progress_hook(self, d):
+        if d['status'] == 'downloading':
+            if d.get('fragment_count') and not self.fragmented:
+                self.fragmented = True
+                self.updated = 0
+            self.progress(d.get('downloaded_bytes') or 0, d.get('total_bytes') or d.get('total_bytes_estimate'))
+    
+    def progress(self, downloaded, total=None):
+        self.downloaded = downloaded
+        if total:
+            self.total = total
+        if time.time() - self.updated >= BANDWIDTH_UPDATE_INTERVAL:
+            self.refresh()
+    
+    def transferred(self, size):
+        """Count bytes fetched outside yt-dlp, sleeping as needed to stay within the allocated rate"""
+        self.progress(self.downloaded + size)
+        if self.rate:
+            self.window_bytes += size
+            ahead = self.window_bytes / self.rate - (time.time() - self.window_start)
+            if ahead > 0:
+                time.sleep(ahead)
+    
+    def refresh(self):
+        if self.finished:
+            return
+        self.updated = time.time()
+        get_db().execute(
+            'INSERT OR REPLACE INTO bandwidth_jobs (id, route, label, total, downloaded, started, updated) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (self.id, self.route, self.label, self.total, self.downloaded, self.started, self.updated)
+        )
+        allocation = bandwidth_allocations().get(self.id)
+        if allocation is None:
+            return
+        if allocation['rate'] != self.rate:
+            # Pace from now on at the new rate
+            self.window_start, self.window_bytes = time.time(), 0
+        self.rate, self.fragments = allocation['rate'], allocation['fragments']
+        for params in self.params:
+            params.update(self.ydl_params())
+    
+    def finish(self):
+        self.finished = True
+        get_db().execute('DELETE FROM bandwidth_jobs WHERE id = ?', (self.id,))
+
+# Streaming downloads in this process, by flight key - finish_flight() ends them
+flight_bandwidth_jobs = {}
+
+def finish_flight_bandwidth(key):
+    job = flight_bandwidth_jobs.pop(key, None)
+    if job:
+        job.finish()
+
+def get_ffmpeg_pool():
+    """This process's post-processing pool (created on first use, so each gunicorn worker gets its own)"""
+    global ffmpeg_pool
+    with ffmpeg_pool_lock:
+        if ffmpeg_pool is None:
+            # spawn: forking a process with request threads running is not safe
+            ffmpeg_pool = ProcessPoolExecutor(max_workers=FFMPEG_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return ffmpeg_pool
+
+def ffmpeg_priority(info):
+    """Queue position for ffmpeg work on a video: its duration (unknown length goes last)"""
+    return info.get('duration') or float('inf')
+
+def run_postprocessors(postprocessors, filepath, ext):
+    """Runs in ffmpeg_pool: apply yt-dlp post-processors to a downloaded file, return the resulting path"""
+    with yt_dlp.YoutubeDL({'quiet': True, 'no_warnings': True, 'logger': SILENT_LOGGER, 'postprocessors': postprocessors}) as ydl:
+        info = ydl.run_all_pps('post_process', {'filepath': filepath, 'ext': ext, '__files_to_move': {}})
+    return info['filepath']
+
+class PooledPostProcessor(yt_dlp.postprocessor.PostProcessor):
+    """Stands in for a download's post-processors and runs them in ffmpeg_pool, keeping the
+    request thread (and the GIL) free for I/O while ffmpeg works"""
+    
+    def __init__(self, downloader, postprocessors):
+        super().__init__(downloader)
+        self.postprocessors = postprocessors
+    
+    def run(self, info):
+        waited = time.time()
+        with ffmpeg_gate.slot(ffmpeg_priority(info)):
+            started = time.time()
+            observe('ytdl_ffmpeg_wait_seconds', started - waited, mode='pool')
+            if started - waited > 0.1:
+                bump_counter('ffmpeg.waited')
+            bump_counter('ffmpeg.jobs')
+            try:
+                filepath = get_ffmpeg_pool().submit(run_postprocessors, self.postprocessors, info['filepath'], info.get('ext')).result()
+            except Exception:
+                bump_counter('ffmpeg.failures')
+                observe('ytdl_postprocess_seconds', time.time() - started, mode='pool', outcome='failed')
+                raise
+            observe('ytdl_postprocess_seconds', time.time() - started, mode='pool', outcome='ok')
+        info['filepath'] = filepath
+        info['ext'] = Path(filepath).suffix.lstrip('.')
+        return [], info
+
+class IndexDownloadPostProcessor(yt_dlp.postprocessor.PostProcessor):
+    """Adds each finished file to the downloads index, with its video ID and format"""
+    
+    def run(self, info):
+        index_download(Path(info['filepath']), info.get('id'), info.get('format_id'))
+        return [], info
+
+def create_downloader(ydl_opts, bandwidth_job=None, index_downloads=False):
+    """YoutubeDL for ydl_opts, with any post-processing moved to the ffmpeg pool"""
+    postprocessors = ydl_opts.get('postprocessors')
+    if not postprocessors:
+        ydl = new_ydl(ydl_opts)
+    else:
+        ydl = new_ydl({key: value for key, value in ydl_opts.items() if key != 'postprocessors'})
+        ydl.add_post_processor(PooledPostProcessor(ydl, postprocessors), when='post_process')
+    if index_downloads:
+        ydl.add_post_processor(IndexDownloadPostProcessor(ydl), when='after_move')
+    if bandwidth_job:
+        bandwidth_job.attach(ydl)
+    return ydl
+
+def run_ydl_download(ydl_opts, url, info=None, bandwidth_job=None):
+    """Download url, or process an already extracted info dict without re-extracting"""
+    with create_downloader(ydl_opts, bandwidth_job) as ydl:
+        if info is not None:
+            # Same path as yt-dlp's --load-info-json: format selection and download only
+            ydl.process_ie_result(copy.deepcopy(info), download=True)
+        else:
+            ydl.download([url])
+
+# Idle instances per option set; only used by the process that created them
+ydl_pool = {}
+ydl_pool_lock = threading.Lock()
+ydl_pool_pid = None
+
+@contextmanager
+def pooled_ydl(ydl_opts):
+    """A YoutubeDL for ydl_opts, reused across requests so its HTTP connections, parsed cookie jar
+    and initialised extractors survive. An instance is only ever used by one thread at a time."""
+    global ydl_pool_pid
+    key = json.dumps(ydl_opts, sort_keys=True, default=repr)
+    with ydl_pool_lock:
+        if ydl_pool_pid != os.getpid():
+            # Inherited over fork (gunicorn --preload) - the parent's connections can't be shared
+            ydl_pool.clear()
+            ydl_pool_pid = os.getpid()
+        idle = ydl_pool.get(key)
+        ydl = idle.pop() if idle else None
+    if ydl is not None and not cookie_jar_current(ydl):
+        # The account's cookie file changed since this instance was made
+        ydl.close()
+        ydl = None
+    if ydl is None:
+        ydl = new_ydl(dict(ydl_opts))
+    
+    reusable = False
+    try:
+        yield ydl
+        reusable = True
+    except yt_dlp_utils.DownloadError:
+        # A failed extraction leaves the instance intact
+        reusable = True
+        raise
+    finally:
+        with ydl_pool_lock:
+            idle = ydl_pool.setdefault(key, [])
+            keep = reusable and ydl_pool_pid == os.getpid() and len(idle) < YDL_POOL_SIZE
+            if keep:
+                idle.append(ydl)
+        if not keep:
+            ydl.close()
+
+def warm_ydl_pool():
+    """Create the extraction instances of every client config ahead of the first request:
+    extractor classes loaded, HTTP handlers built, cookies.txt parsed"""
+    cookies_file = pick_cookie_account()
+    has_cookies = cookies_file is not None
+    for config in client_configs_for(has_cookies):
+        for ydl_opts in (info_ydl_opts(config, has_cookies, cookies_file),
+                         raw_info_ydl_opts(config, has_cookies, cookies_file)):
+            with pooled_ydl(ydl_opts) as ydl:
+                ydl.get_info_extractor('Youtube')
+                ydl._request_director
+                if has_cookies:
+                    ydl.cookiejar
+
+def raw_info_ydl_opts(config, has_cookies, cookies_file):
+    """Options for extract_raw_info with one client config"""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'logger': SILENT_LOGGER,
+        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'referer': 'https://www.youtube.com/',
+        'extractor_retries': 3,
+    }
+    return apply_client_config(ydl_opts, config, has_cookies, cookies_file)
+
+def extract_raw_info(url, config, has_cookies, cookies_file):
+    """Extract metadata for one client config (no format selection yet), recording the outcome"""
+    started = time.time()
+    try:
+        with pooled_ydl(raw_info_ydl_opts(config, has_cookies, cookies_file)) as ydl:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False, process=False))
+    except Exception as e:
+        record_client_failure(cookies_file, config, e)
+        observe('ytdl_attempt_seconds', time.time() - started, phase='extract', client=client_label(config), outcome=classify_error(str(e)))
+        raise
+    record_client_result(cookies_file, config, True, time.time() - started)
+    observe('ytdl_attempt_seconds', time.time() - started, phase='extract', client=client_label(config), outcome='ok')
+    return info
+
+def find_downloaded_file(temp_dir):
+    """Finished file in a download directory (ignores yt-dlp's partial files)"""
+    for file_path in Path(temp_dir).glob('*'):
+        if file_path.is_file() and not file_path.name.endswith(('.part', '.ytdl')):
+            return file_path
+    return None
+
+def content_type_for(ext):
+    """MIME type sent for a downloaded file extension"""
+    ext = ext.lower().lstrip('.')
+    return 'video/mp4' if ext == 'mp4' else 'audio/mpeg' if ext == 'mp3' else 'application/octet-stream'
+
+def open_origin_stream(ydl, fmt, bandwidth_job=None):
+    """Proxy a single-file format straight from the origin, without a temp file.
+    
+    Fetches in ranged requests (like yt-dlp's http_chunk_size) so YouTube doesn't throttle
+    the connection. Returns (total size or None, chunk generator). The first request is made
+    before returning, so access errors surface while a fallback is still possible.
+    """
+    headers = dict(fmt.get('http_headers') or {})
+    
+    def fetch(start):
+        range_headers = dict(headers, Range=f'bytes={start}-{start + STREAM_RANGE_SIZE - 1}')
+        try:
+            return ydl.urlopen(YtdlpRequest(fmt['url'], headers=range_headers))
+        except YtdlpRequestError as e:
+            # Worded like yt-dlp's own download errors, so classify_error() sees a media fetch
+            raise yt_dlp_utils.DownloadError(f'unable to download video data: {e}') from e
+    
+    first = fetch(0)
+    ranged = first.status == 206
+    total = fmt.get('filesize')
+    if ranged:
+        content_range = first.headers.get('Content-Range', '')
+        if content_range.rpartition('/')[2].isdigit():
+            total = int(content_range.rpartition('/')[2])
+    elif first.headers.get('Content-Length', '').isdigit():
+        total = int(first.headers['Content-Length'])
+    
+    def generate():
+        response = first
+        position = 0
+        try:
+            while True:
+                chunk = response.read(STREAM_CHUNK_SIZE)
+                if chunk:
+                    position += len(chunk)
+                    if bandwidth_job:
+                        bandwidth_job.transferred(len(chunk))
+                    yield chunk
+                    continue
+                response.close()
+                # Server ignored Range (sent everything) or we reached the end
+                if not ranged or total is None or position >= total:
+                    break
+                response = fetch(position)
+        finally:
+            response.close()
+            ydl.close()
+    
+    return total, generate()
+
+def result_cache_key(video_key, format_id, postprocessors):
+    """Content address of a finished download: video + resolved format + post-processing"""
+    raw = json.dumps([video_key, format_id, postprocessors or []], sort_keys=True)
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+def result_path(key):
+    return RESULT_CACHE_DIR / f'{key}.data'
+
+def result_part_path(key):
+    return RESULT_CACHE_DIR / f'{key}.data.part'
+
+def lookup_result(key):
+    """Metadata of a completely cached result, or None"""
+    db = get_db()
+    row = db.execute(
+        'SELECT filename, ext, size FROM result_cache WHERE key = ? AND complete = 1', (key,)
+    ).fetchone()
+    if not row:
+        return None
+    if not result_path(key).exists():
+        db.execute('DELETE FROM result_cache WHERE key = ?', (key,))
+        return None
+    db.execute('UPDATE result_cache SET accessed = ? WHERE key = ?', (time.time(), key))
+    return {'filename': row[0], 'ext': row[1], 'size': row[2]}
+
+def lookup_result_alias(alias):
+    """Cached result for a (video, requested format, post-processing) request, without extracting"""
+    row = get_db().execute('SELECT key FROM result_aliases WHERE alias = ?', (alias,)).fetchone()
+    if not row:
+        return None, None
+    return row[0], lookup_result(row[0])
+
+def try_lead_flight(key):
+    """Become the one request (in any worker) that downloads key.
+    
+    Returns the held lock file, or None if another request is already downloading it.
+    """
+    path = RESULT_CACHE_DIR / f'{key}.lock'
+    while True:
+        lock = open(path, 'a+b')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock.close()
+            return None
+        # The file may have been removed (see remove_flight_lock) between open and flock
+        try:
+            if os.stat(path).st_ino == os.fstat(lock.fileno()).st_ino:
+                return lock
+        except FileNotFoundError:
+            pass
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+def remove_flight_lock(key):
+    """Delete the lock file of a key nobody is downloading"""
+    lock = try_lead_flight(key)
+    if lock:
+        (RESULT_CACHE_DIR / f'{key}.lock').unlink(missing_ok=True)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+
+def flight_in_progress(key):
+    """True while some request holds the download lock for key"""
+    try:
+        with open(RESULT_CACHE_DIR / f'{key}.lock', 'rb') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            return False
+    except FileNotFoundError:
+        return False
+    except BlockingIOError:
+        return True
+
+def begin_result(key, filename, ext, expected_size):
+    """Announce an in-progress result so followers know its name and size"""
+    now = time.time()
+    get_db().execute(
+        'INSERT OR REPLACE INTO result_cache (key, filename, ext, size, complete, created, accessed) '
+        'VALUES (?, ?, ?, ?, 0, ?, ?)',
+        (key, filename, ext, expected_size, now, now)
+    )
+
+def finish_flight(key, lock, ok, alias=None):
+    """Publish (or discard) the leader's result and release the single-flight lock"""
+    db = get_db()
+    try:
+        part = result_part_path(key)
+        if ok and part.exists():
+            os.replace(part, result_path(key))
+        if ok and not result_path(key).exists():
+            # yt-dlp reported success but its output isn't where we expected it
+            ok = False
+        if ok:
+            db.execute(
+                'UPDATE result_cache SET size = ?, complete = 1, accessed = ? WHERE key = ?',
+                (result_path(key).stat().st_size, time.time(), key)
+            )
+            if alias:
+                db.execute(
+                    'INSERT OR REPLACE INTO result_aliases (alias, key, created) VALUES (?, ?, ?)',
+                    (alias, key, time.time())
+                )
+            bump_counter('result_cache.stored')
+        else:
+            part.unlink(missing_ok=True)
+            db.execute('DELETE FROM result_cache WHERE key = ?', (key,))
+    finally:
+        # Released while still holding the lock - the reaper treats unlocked reservations as orphans
+        release_temp_space(key)
+        finish_flight_bandwidth(key)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+    if ok:
+        # The result just published is never evicted right away - its requests are about to read it
+        evict_results(keep=key)
+
+def evict_results(keep=None):
+    """Delete least recently used results until the cache fits RESULT_CACHE_MAX_BYTES"""
+    db = get_db()
+    total = db.execute('SELECT COALESCE(SUM(size), 0) FROM result_cache WHERE complete = 1').fetchone()[0]
+    if total <= RESULT_CACHE_MAX_BYTES:
+        return
+    for key, size in db.execute(
+        'SELECT key, size FROM result_cache WHERE complete = 1 ORDER BY accessed'
+    ).fetchall():
+        if total <= RESULT_CACHE_MAX_BYTES:
+            break
+        if key == keep:
+            continue
+        # Requests already streaming the file keep their open handle
+        result_path(key).unlink(missing_ok=True)
+        remove_flight_lock(key)
+        db.execute('DELETE FROM result_cache WHERE key = ?', (key,))
+        db.execute('DELETE FROM result_aliases WHERE key = ?', (key,))
+        bump_counter('result_cache.evicted')
+        total -= size or 0
+
+def result_cache_stats():
+    """Size and hit counters of the download result cache"""
+    counters = read_counters('result_cache.')
+    entries, total = get_db().execute(
+        'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM result_cache WHERE complete = 1'
+    ).fetchone()
+    return {
+        'entries': entries,
+        'bytes': total,
+        'max_bytes': RESULT_CACHE_MAX_BYTES,
+        'hits': counters.get('hits', 0),
+        'coalesced': counters.get('coalesced', 0),
+        'misses': counters.get('misses', 0),
+        'evicted': counters.get('evicted', 0),
+    }
+
+class DownloadProducedNoFile(Exception):
+    """A download finished without output - retrying with another client would only repeat it"""
+
+class TempQuotaExceeded(Exception):
+    """Downloads in progress already use up TEMP_QUOTA_BYTES"""
+
+def expected_download_size(selected):
+    """Bytes a selected format (or format pair, if merged) will take on disk"""
+    sizes = [format_size(f)[0] for f in selected.get('requested_formats') or [selected]]
+    return sum(sizes) if all(sizes) else TEMP_DEFAULT_RESERVATION
+
+def reserve_temp_space(key, size):
+    """Claim quota for the download of key before it starts; raises TempQuotaExceeded if it doesn't fit"""
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        used = db.execute(
+            'SELECT COALESCE(SUM(bytes), 0) FROM temp_reservations WHERE key != ?', (key,)
+        ).fetchone()[0]
+        # A single download larger than the whole quota may still run on its own
+        fits = used == 0 or used + size <= TEMP_QUOTA_BYTES
+        if fits:
+            db.execute(
+                'INSERT OR REPLACE INTO temp_reservations (key, bytes, pid, created) VALUES (?, ?, ?, ?)',
+                (key, size, os.getpid(), time.time())
+            )
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    if not fits:
+        bump_counter('temp.rejected')
+        raise TempQuotaExceeded(f'Temp storage full ({used} of {TEMP_QUOTA_BYTES} bytes reserved)')
+
+def release_temp_space(key):
+    get_db().execute('DELETE FROM temp_reservations WHERE key = ?', (key,))
+
+def temp_space_available():
+    """False when new downloads would be turned away anyway"""
+    used = get_db().execute('SELECT COALESCE(SUM(bytes), 0) FROM temp_reservations').fetchone()[0]
+    return used < TEMP_QUOTA_BYTES
+
+def make_temp_dir():
+    """Temp dir named after the owning process, so the reaper can tell when it is orphaned"""
+    return tempfile.mkdtemp(prefix=f'{TEMP_DIR_PREFIX}{os.getpid()}-')
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def newest_mtime(path):
+    """Latest modification time of a directory or anything below it"""
+    newest = path.stat().st_mtime
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                newest = max(newest, os.lstat(os.path.join(root, name)).st_mtime)
+            except OSError:
+                pass
+    return newest
+
+def reap_temp_storage():
+    """Remove what dead or abandoned downloads left behind: reservations, temp dirs and
+    unfinished cache files. A download in progress always holds its flight lock."""
+    db = get_db()
+    now = time.time()
+    for key, in db.execute('SELECT key FROM temp_reservations').fetchall():
+        if not flight_in_progress(key):
+            # Only the row we saw - a new leader for the same key may have just reserved
+            db.execute('DELETE FROM temp_reservations WHERE key = ? AND created < ?', (key, now))
+            bump_counter('temp.reaped_reservations')
+    
+    for path in Path(tempfile.gettempdir()).glob(TEMP_DIR_PREFIX + '*'):
+        match = re.match(rf'{re.escape(TEMP_DIR_PREFIX)}(\d+)-', path.name)
+        if match and not process_alive(int(match.group(1))):
+            orphaned = True
+        else:
+            # The dir's own mtime stays put while a .part file inside grows - go by the newest write
+            try:
+                idle = now - newest_mtime(path)
+            except FileNotFoundError:
+                continue
+            orphaned = idle > TEMP_ORPHAN_AGE
+        if orphaned:
+            shutil.rmtree(path, ignore_errors=True)
+            bump_counter('temp.reaped_dirs')
+    
+    # .part files and yt-dlp's per-format pieces of flights whose leader is gone, and the
+    # lock files of flights that failed (evict_results() removes those of evicted results)
+    if RESULT_CACHE_DIR.is_dir():
+        for path in RESULT_CACHE_DIR.iterdir():
+            if path.suffix == '.data':
+                continue
+            if path.suffix == '.lock':
+                if not result_path(path.stem).exists():
+                    remove_flight_lock(path.stem)
+                continue
+            try:
+                # Recently touched files may belong to a leader that is just starting
+                if now - path.stat().st_mtime < TEMP_REAP_INTERVAL:
+                    continue
+            except FileNotFoundError:
+                continue
+            if not flight_in_progress(path.name.split('.')[0]):
+                path.unlink(missing_ok=True)
+                bump_counter('temp.reaped_files')
+    for key, in db.execute('SELECT key FROM result_cache WHERE complete = 0').fetchall():
+        if not flight_in_progress(key):
+            db.execute('DELETE FROM result_cache WHERE key = ? AND complete = 0 AND created < ?', (key, now))
+
+def temp_reaper():
+    """Background loop of reap_temp_storage(), one per worker"""
+    while True:
+        try:
+            reap_temp_storage()
+        except Exception:
+            pass
+        time.sleep(TEMP_REAP_INTERVAL)
+
+def temp_storage_stats():
+    counters = read_counters('temp.')
+    reservations, reserved = get_db().execute(
+        'SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM temp_reservations'
+    ).fetchone()
+    return {
+        'downloads': reservations,
+        'reserved_bytes': reserved,
+        'quota_bytes': TEMP_QUOTA_BYTES,
+        'rejected': counters.get('rejected', 0),
+        'reaped_dirs': counters.get('reaped_dirs', 0),
+        'reaped_files': counters.get('reaped_files', 0),
+    }
+
+def open_result(key):
+    """Open a result for reading - the finished file, or the .part file its leader is writing"""
+    for path in (result_part_path(key), result_path(key)):
+        try:
+            return open(path, 'rb')
+        except FileNotFoundError:
+            continue
+    return None
+
+def read_file_range(f, length):
+    """Yield exactly length bytes from the current position, then close the file"""
+    with f:
+        while length > 0:
+            chunk = f.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def content_disposition(download_name):
+    """Attachment header for any file name: an ASCII fallback plus the UTF-8 name (RFC 6266),
+    the way werkzeug's send_file builds it"""
+    name = ''.join(c for c in download_name if unicodedata.category(c) != 'Cc')
+    simple = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+    simple = simple.replace('\\', '\\\\').replace('"', '\\"')
+    if simple == name:
+        return f'attachment; filename="{simple}"'
+    return f"attachment; filename=\"{simple}\"; filename*=UTF-8''{quote(name, safe='')}"
+
+def send_file_ranged(path, download_name, mimetype, etag):
+    """Serve a finished file with Range / If-Range / ETag support.
+    
+    Whole-file and open-ended (resume) ranges go through wsgi.file_wrapper, which gunicorn
+    sends with os.sendfile() - the bytes never pass through Python. Other ranges are read
+    in chunks.
+    """
+    f = open(path, 'rb')
+    stat = os.fstat(f.fileno())
+    size = stat.st_size
+    headers = {
+        'Content-Disposition': content_disposition(download_name),
+        'Accept-Ranges': 'bytes',
+        'ETag': f'"{etag}"',
+    }
+    
+    if request.if_none_match.contains(etag):
+        f.close()
+        return Response(status=304, headers=headers)
+    
+    start, end, status = 0, size, 200
+    byte_range = request.range
+    # If-Range: only resume if the file is still the one the client started with
+    if_range = request.if_range
+    range_valid = not (if_range.etag or if_range.date) or if_range.etag == etag or (
+        if_range.date is not None and int(if_range.date.timestamp()) >= int(stat.st_mtime)
+    )
+    if byte_range and range_valid and len(byte_range.ranges) == 1:
+        satisfiable = byte_range.range_for_length(size)
+        if satisfiable is None:
+            f.close()
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+        start, end = satisfiable
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+    
+    if request.method == 'HEAD':
+        # No body is sent, so nothing would ever close the file
+        f.close()
+        response = Response(status=status, mimetype=mimetype, headers=headers)
+        response.headers['Content-Length'] = str(end - start)
+        return response
+    f.seek(start)
+    if end == size:
+        body = wrap_file(request.environ, f, STREAM_CHUNK_SIZE)
+    else:
+        body = read_file_range(f, end - start)
+    response = Response(body, status=status, mimetype=mimetype, headers=headers, direct_passthrough=True)
+    response.headers['Content-Length'] = str(end - start)
+    return response
+
+def serve_result(key, f):
+    """Send a cached result; if its download is still running, follow it as it grows.
+    Returns None (a cache miss) if the result was evicted or discarded meanwhile."""
+    row = get_db().execute(
+        'SELECT filename, ext, size, complete FROM result_cache WHERE key = ?', (key,)
+    ).fetchone()
+    if row is None:
+        f.close()
+        return None
+    filename, ext, size, complete = row
+    
+    if complete:
+        # Content-addressed, so the key itself is a strong ETag
+        f.close()
+        return send_file_ranged(result_path(key), filename, content_type_for(ext or ''), key)
+    
+    headers = {'Content-Disposition': content_disposition(filename)}
+    status, remaining = 200, None
+    if size:
+        # Known size - a resumed transfer can pick up from any offset, even one not fetched yet
+        headers['Accept-Ranges'] = 'bytes'
+        headers['ETag'] = f'"{key}"'
+        byte_range = request.range
+        if_range = request.if_range
+        if byte_range and len(byte_range.ranges) == 1 and if_range.etag in (None, key) and not if_range.date:
+            satisfiable = byte_range.range_for_length(size)
+            if satisfiable is None:
+                f.close()
+                headers['Content-Range'] = f'bytes */{size}'
+                return Response(status=416, headers=headers)
+            start, end = satisfiable
+            f.seek(start)
+            status, remaining = 206, end - start
+            headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+        headers['Content-Length'] = str(remaining if remaining is not None else size)
+    if request.method == 'HEAD':
+        f.close()
+        return Response(status=status, mimetype=content_type_for(ext or ''), headers=headers)
+    
+    def generate():
+        nonlocal f, remaining
+        try:
+            # The handle stays valid when the leader renames .part to the final name
+            while remaining != 0:
+                chunk = f.read(STREAM_CHUNK_SIZE if remaining is None else min(STREAM_CHUNK_SIZE, remaining))
+                if chunk:
+                    if remaining is not None:
+                        remaining -= len(chunk)
+                    yield chunk
+                elif not flight_in_progress(key):
+                    chunk = f.read() if remaining is None else f.read(remaining)
+                    if chunk:
+                        if remaining is not None:
+                            remaining -= len(chunk)
+                        yield chunk
+                    f = switch_to_final_result(key, f)
+                    if f is None:
+                        break
+                else:
+                    time.sleep(0.05)
+        finally:
+            if f:
+                f.close()
+    
+    return Response(stream_with_context(generate()), status=status, mimetype=content_type_for(ext or ''), headers=headers)
+
+def switch_to_final_result(key, f):
+    """If the leader replaced the file we were following (e.g. it had to redo a conversion),
+    continue from the same offset in the final file. Returns the new handle, or None when done."""
+    try:
+        final = open(result_path(key), 'rb')
+    except FileNotFoundError:
+        return None
+    if os.fstat(final.fileno()).st_ino == os.fstat(f.fileno()).st_ino:
+        final.close()
+        return None
+    final.seek(f.tell())
+    f.close()
+    return final
+
+def audio_conversion(selected, postprocessors):
+    """How to turn the selected format into the requested audio file.
+    
+    'passthrough' - the source already is the requested codec and container, send it as is
+    'remux'       - right codec, other container: copy the stream (cheap)
+    'transcode'   - re-encode (CPU-bound)
+    None          - no audio conversion requested
+    """
+    if not postprocessors or len(postprocessors) != 1 or postprocessors[0].get('key') != 'FFmpegExtractAudio':
+        return None
+    target = postprocessors[0].get('preferredcodec', 'best')
+    acodec = (selected.get('acodec') or '').lower()
+    source = 'm4a' if acodec.startswith('mp4a') else acodec.split('.')[0]
+    if target != 'best' and source != target:
+        return 'transcode'
+    audio_only = selected.get('vcodec') in (None, 'none') and 'requested_formats' not in selected
+    if audio_only and selected.get('ext') == AUDIO_CONTAINERS.get(source):
+        return 'passthrough'
+    return 'remux'
+
+def lead_transcode(key, lock, ydl, selected, postprocessor, filename, alias, bandwidth_job=None):
+    """Transcode while downloading: origin bytes are piped into ffmpeg, whose output goes
+    straight into the cache file that this request (and any followers) stream from.
+    
+    Returns True once output is flowing (the worker thread then owns the lock), or False -
+    with the lock still held - if ffmpeg failed before producing anything.
+    """
+    codec = postprocessor.get('preferredcodec', 'mp3')
+    args = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-i', 'pipe:0', '-vn'] + TRANSCODE_ARGS[codec]
+    if postprocessor.get('preferredquality'):
+        args += ['-b:a', f"{postprocessor['preferredquality']}k"]
+    args.append('pipe:1')
+    
+    try:
+        total, chunks = open_origin_stream(ydl, selected, bandwidth_job)
+    except BaseException:
+        ydl.close()
+        finish_flight(key, lock, False)
+        raise
+    begin_result(key, f'{Path(filename).stem}.{codec}', codec, None)
+    part = result_part_path(key)
+    # Held until ffmpeg exits, so streaming transcodes count against the same CPU budget
+    admission = ffmpeg_gate.slot(ffmpeg_priority(selected))
+    waited = time.time()
+    try:
+        admission.__enter__()
+        started = time.time()
+        observe('ytdl_ffmpeg_wait_seconds', started - waited, mode='stream')
+        bump_counter('ffmpeg.jobs')
+        with open(part, 'wb') as out:
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=out, stderr=subprocess.DEVNULL)
+    except BaseException:
+        admission.__exit__(None, None, None)
+        chunks.close()
+        finish_flight(key, lock, False)
+        raise
+    state = {'handed_off': False, 'abandoned': False}
+    guard = threading.Lock()
+    
+    def worker():
+        ok = False
+        try:
+            try:
+                for chunk in chunks:
+                    proc.stdin.write(chunk)
+            except BrokenPipeError:
+                # ffmpeg gave up - its exit code says why
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+            ok = proc.wait() == 0
+        except BaseException:
+            proc.kill()
+            proc.wait()
+        finally:
+            admission.__exit__(None, None, None)
+            chunks.close()
+            observe('ytdl_postprocess_seconds', time.time() - started, mode='stream', outcome='ok' if ok else 'failed')
+            if not ok:
+                bump_counter('ffmpeg.failures')
+            with guard:
+                # Nothing produced and nobody streaming yet: the caller falls back and keeps the lock
+                state['abandoned'] = not ok and not state['handed_off'] and not (part.exists() and part.stat().st_size > 0)
+            if not state['abandoned']:
+                finish_flight(key, lock, ok, alias)
+    
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    wait_for_first_bytes(key, thread)
+    with guard:
+        if state['abandoned']:
+            part.unlink(missing_ok=True)
+            return False
+        state['handed_off'] = True
+    return True
+
+def wait_for_first_bytes(key, worker):
+    """Wait until the leader's worker thread has written something (or failed)"""
+    while worker.is_alive():
+        part = result_part_path(key)
+        if (part.exists() and part.stat().st_size > 0) or result_path(key).exists():
+            return
+        time.sleep(0.05)
+
+def lead_download(key, lock, ydl, url, info, selected, ydl_opts, alias):
+    """Fetch a result as the single-flight leader; other requests follow the same file.
+    
+    Single-file http(s) formats are proxied straight into the cache file. Formats without
+    post-processing are written there by yt-dlp (.part first, so followers can read behind it).
+    Audio that already has the requested codec is sent untouched; audio that needs re-encoding
+    is transcoded by ffmpeg while it downloads. Other post-processed downloads are produced
+    in a temp dir and moved in when complete.
+    """
+    # Leftover from a leader that died mid-download
+    result_part_path(key).unlink(missing_ok=True)
+    try:
+        reserve_temp_space(key, expected_download_size(selected))
+    except BaseException:
+        ydl.close()
+        finish_flight(key, lock, False)
+        raise
+    # Ended by finish_flight(), like the reservation
+    job = flight_bandwidth_jobs[key] = BandwidthJob(key, 'download', url, expected_download_size(selected))
+    ext = selected.get('ext')
+    filename = ydl.evaluate_outtmpl(DOWNLOAD_NAME_TEMPLATE, selected, sanitize=True)
+    direct = 'requested_formats' not in selected and selected.get('protocol') in ('http', 'https')
+    conversion = audio_conversion(selected, ydl_opts.get('postprocessors'))
+    
+    # ffmpeg can only read containers that don't need seeking (MP4 indexes may sit at the end)
+    streamable = ext in STREAMABLE_CONTAINERS or (selected.get('container') or '').endswith('_dash')
+    if conversion == 'transcode' and direct and streamable and shutil.which('ffmpeg'):
+        if lead_transcode(key, lock, ydl, selected, ydl_opts['postprocessors'][0], filename, alias, job):
+            return
+        # ffmpeg couldn't read the stream from a pipe - convert the whole file
+        bump_counter('audio.transcode_fallbacks')
+    
+    if ydl_opts.get('postprocessors') and not (conversion == 'passthrough' and direct):
+        ydl.close()
+        temp_dir = make_temp_dir()
+        try:
+            run_ydl_download(dict(ydl_opts, outtmpl=str(Path(temp_dir) / DOWNLOAD_NAME_TEMPLATE)), url, info, job)
+            temp_file = find_downloaded_file(temp_dir)
+            if not temp_file:
+                raise DownloadProducedNoFile('Download produced no file')
+            begin_result(key, temp_file.name, temp_file.suffix.lstrip('.'), None)
+            shutil.move(str(temp_file), str(result_part_path(key)))
+        except BaseException:
+            finish_flight(key, lock, False)
+            raise
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        finish_flight(key, lock, True, alias)
+        return
+    
+    state = {'ok': False, 'error': None}
+    if 'requested_formats' not in selected and selected.get('protocol') in ('http', 'https'):
+        try:
+            total, chunks = open_origin_stream(ydl, selected, job)
+            begin_result(key, filename, ext, total)
+            out = open(result_part_path(key), 'wb')
+        except BaseException:
+            ydl.close()
+            finish_flight(key, lock, False)
+            raise
+        
+        def fetch():
+            with out:
+                for chunk in chunks:
+                    out.write(chunk)
+    elif 'requested_formats' in selected:
+        # yt-dlp appends the container extension to merged output, so it is built in a temp dir
+        # and moved in once complete (followers wait for it, there is nothing to read before)
+        begin_result(key, filename, ext, None)
+        temp_dir = make_temp_dir()
+        ydl.params['outtmpl'] = {'default': str(Path(temp_dir) / f'{key}.%(ext)s')}
+        job.attach(ydl)
+        
+        def fetch():
+            try:
+                result = ydl.process_ie_result(copy.deepcopy(info), download=True)
+                downloads = result.get('requested_downloads') or [{}]
+                filepath = downloads[0].get('filepath')
+                if not filepath or not os.path.exists(filepath):
+                    raise DownloadProducedNoFile('Download produced no file')
+                shutil.move(filepath, str(result_part_path(key)))
+            finally:
+                ydl.close()
+                shutil.rmtree(temp_dir, ignore_errors=True)
+    else:
+        begin_result(key, filename, ext, None)
+        ydl.params['outtmpl'] = {'default': str(result_path(key))}
+        job.attach(ydl)
+        
+        def fetch():
+            try:
+                ydl.process_ie_result(copy.deepcopy(info), download=True)
+            finally:
+                ydl.close()
+    
+    def worker():
+        # Runs to completion even if this client disconnects - followers may still need it
+        try:
+            fetch()
+            state['ok'] = True
+        except BaseException as e:
+            state['error'] = e
+        finally:
+            finish_flight(key, lock, state['ok'], alias)
+    
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    wait_for_first_bytes(key, thread)
+    if state['error']:
+        raise state['error']
+
+def result_alias(url, format_str, postprocessors):
+    """Name of a download request before format resolution: video + requested format + post-processing"""
+    return json.dumps([info_cache_key(url), format_str, postprocessors or []], sort_keys=True)
+
+def serve_cached_request(url, format_str, postprocessors):
+    """Response for a request whose result is already cached, or None"""
+    key, cached = lookup_result_alias(result_alias(url, format_str, postprocessors))
+    if cached:
+        f = open_result(key)
+        response = serve_result(key, f) if f else None
+        if response is not None:
+            bump_counter('result_cache.hits')
+            return response
+    return None
+
+def download_through_cache(ydl_opts, url, info, format_str):
+    """Serve a download from the result cache, joining or leading the in-progress fetch"""
+    video_key = info_cache_key(url)
+    postprocessors = ydl_opts.get('postprocessors') or []
+    alias = result_alias(url, format_str, postprocessors)
+    
+    ydl = new_ydl(ydl_opts)
+    try:
+        if info is None:
+            info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+        selected = ydl.process_ie_result(copy.deepcopy(info), download=False)
+    except BaseException:
+        ydl.close()
+        raise
+    key = result_cache_key(video_key, selected.get('format_id'), postprocessors)
+    
+    deadline = time.time() + RESULT_FOLLOW_TIMEOUT
+    while True:
+        lock = try_lead_flight(key)
+        if lock:
+            # Someone may have finished it just before we got the lock
+            if lookup_result(key):
+                f = open_result(key)
+                response = serve_result(key, f) if f else None
+                if response is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                    lock.close()
+                    ydl.close()
+                    bump_counter('result_cache.hits')
+                    return response
+                # Evicted in the meantime - download it after all
+            bump_counter('result_cache.misses')
+            lead_download(key, lock, ydl, url, info, selected, ydl_opts, alias)
+            f = open_result(key)
+            if not f:
+                raise DownloadProducedNoFile('Download produced no file')
+            response = serve_result(key, f)
+            if response is not None:
+                return response
+            # Evicted by another request before we could send it - lead again
+            ydl = new_ydl(ydl_opts)
+            continue
+        
+        # Another request is downloading the same thing - stream behind it
+        if get_db().execute('SELECT 1 FROM result_cache WHERE key = ?', (key,)).fetchone():
+            f = open_result(key)
+            response = serve_result(key, f) if f else None
+            if response is not None:
+                ydl.close()
+                bump_counter('result_cache.coalesced')
+                return response
+        if time.time() > deadline:
+            ydl.close()
+            raise yt_dlp_utils.DownloadError('Timed out waiting for an identical download')
+        time.sleep(0.1)
+
+class SilentLogger:
+    """yt-dlp logger that discards all output"""
+    def debug(self, msg):
+        pass
+    
+    def info(self, msg):
+        pass
+    
+    def warning(self, msg):
+        pass
+    
+    def error(self, msg):
+        pass
+
+SILENT_LOGGER = SilentLogger()
+
+HEDGE_POOL_SIZE = max(HEDGE_FANOUT, 1) * 4
+hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_POOL_SIZE, thread_name_prefix='hedge')
+# Attempts currently running on hedge_executor, abandoned losers included
+hedge_running = {'count': 0}
+hedge_running_lock = threading.Lock()
+
+def run_hedged(attempt, client_configs, errors, stop_when=is_permanent_error):
+    """Run attempt(config) over the configs, hedging slow ones.
     
+    Up to HEDGE_FANOUT attempts run at once. The next config starts as soon as an attempt
+    fails, or when the newest one has been running for HEDGE_DELAY without an answer. The
+    delay counts from when a pool thread picks the attempt up, and no hedge starts while the
+    pool is busy - otherwise attempts waiting in the queue would trigger more attempts.
+    The first success wins and attempts that haven't started are cancelled (running ones
+    finish in the background and are ignored). Errors matching stop_when (by default:
+    permanent ones, like a removed video) end the whole chain. Returns (config, result),
+    or (None, None) with every error message appended to errors.
+    """
+    if HEDGE_FANOUT <= 1:
+        for config in client_configs:
+            try:
+                return config, attempt(config)
+            except Exception as e:
+                errors.append(str(e))
+                if stop_when and stop_when(e):
+                    break
+        return None, None
+    
+    queue = list(client_configs)
+    pending = {}
+    newest = {}
+    
+    def run(config, started):
+        with hedge_running_lock:
+            hedge_running['count'] += 1
+        started['at'] = time.time()
+        try:
+            return attempt(config)
+        finally:
+            with hedge_running_lock:
+                hedge_running['count'] -= 1
+    
+    def launch():
+        nonlocal newest
+        if queue and len(pending) < HEDGE_FANOUT:
+            config = queue.pop(0)
+            newest = {}
+            pending[hedge_executor.submit(run, config, newest)] = config
+    
+    def hedge_wait():
+        """Seconds until the newest attempt is due a hedge (re-checked while it is still queued)"""
+        if 'at' not in newest or hedge_running['count'] >= HEDGE_POOL_SIZE:
+            return min(HEDGE_DELAY, 0.25)
+        return max(newest['at'] + HEDGE_DELAY - time.time(), 0)
+    
+    launch()
+    try:
+        while pending:
+            can_hedge = bool(queue) and len(pending) < HEDGE_FANOUT
+            done, _ = wait(pending, timeout=hedge_wait() if can_hedge else None, return_when=FIRST_COMPLETED)
+            if not done:
+                if 'at' in newest and time.time() - newest['at'] >= HEDGE_DELAY \
+                        and hedge_running['count'] < HEDGE_POOL_SIZE:
+                    # Nobody answered in time - start the next client alongside
+                    bump_counter('hedge.launched')
+                    launch()
+                continue
+            for future in done:
+                config = pending.pop(future)
+                try:
+                    return config, future.result()
+                except Exception as e:
+                    errors.append(str(e))
+                    if stop_when and stop_when(e):
+                        return None, None
+            # A failure frees its slot for the next client right away
+            launch()
+    finally:
+        for future in pending:
+            future.cancel()
+    return None, None
+
+def client_configs_for(has_cookies, for_download=False):
+    """Player client configs tried for metadata extraction (or downloads), in their default order"""
+    if has_cookies and for_download:
+        # Downloads try android_vr first (proven to work), then cookie clients as fallback
+        return [
+            {'player_client': ['android_vr'], 'no_cookies': True},
+            {},  # Default - yt-dlp will auto-select based on account type
+            {'player_client': ['tv_downgraded', 'web', 'web_safari']},  # Free account fallback
+            {'player_client': ['tv_downgraded', 'web_creator', 'web']},  # Premium account fallback
+            {'player_client': ['web']},
+        ]
     # According to yt-dlp README: when cookies are present, yt-dlp automatically uses
     # tv_downgraded,web,web_safari for free accounts or tv_downgraded,web_creator,web for premium
     # So we should let yt-dlp use defaults when cookies are present
     # Note: android_vr doesn't support cookies, so we try it as fallback
     if has_cookies:
         # With cookies, try cookie-supported clients first
-        client_configs = [
+        return [
             {},  # Default - yt-dlp will auto-select based on account type
             {'player_client': ['tv_downgraded', 'web', 'web_safari']},  # Free account fallback
             {'player_client': ['tv_downgraded', 'web_creator', 'web']},  # Premium account fallback
@@ -41,114 +2062,222 @@ def get_video_info(url):
             # Fallback: try android_vr without cookies if cookie clients fail
             {'player_client': ['android_vr'], 'no_cookies': True},
         ]
+    # Without cookies, try different clients
+    return [
+        {'player_client': ['android_vr']},  # Works without JS runtime
+        {'player_client': ['android_vr', 'web', 'web_safari']},
+        {'player_client': ['web']},
+        {'player_client': ['mweb', 'web']},
+        {},  # No extractor args
+    ]
+
+def download_formats(format_type, quality, audio_format, format_id=None):
+    """Format selectors to try in order, and the audio postprocessor (or None), for download options"""
+    if format_id:
+        # Exact format from /api/info's ladder - no fallback selectors or retries
+        format_configs = [format_id]
+    elif format_type == 'audio':
+        # Prefers a source in the requested codec - yt-dlp then only copies the stream
+        format_configs = [AUDIO_FORMATS[audio_format][0], 'best']
+    elif quality == 'best':
+        # Single file, no merging needed, no ffmpeg required
+        format_configs = ['best']
     else:
-        # Without cookies, try different clients
-        client_configs = [
-            {'player_client': ['android_vr']},  # Works without JS runtime
-            {'player_client': ['android_vr', 'web', 'web_safari']},
-            {'player_client': ['web']},
-            {'player_client': ['mweb', 'web']},
-            {},  # No extractor args
-        ]
+        # Try quality-specific single format, fallback to best
+        format_configs = [f'best[height<={quality[:-1]}]', 'best']
+    audio_postprocessor = AUDIO_FORMATS[audio_format][1] if format_type == 'audio' else None
+    return format_configs, audio_postprocessor
+
+def info_ydl_opts(config, has_cookies, cookies_file):
+    """Options for the /api/info extraction with one client config"""
+    ydl_opts = {
+        'quiet': True,
+        'no_warnings': True,
+        'skip_download': True,
+        'writesubtitles': False,
+        'writeautomaticsub': False,
+        'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        'referer': 'https://www.youtube.com/',
+        'extractor_retries': 3,
+        # Swallow yt-dlp's stderr output (redirect_stderr isn't safe with parallel attempts)
+        'logger': SILENT_LOGGER,
+    }
+    return apply_client_config(ydl_opts, config, has_cookies, cookies_file)
+
+# An exact format from /api/info's format ladder: "18", "251-drc" or "137+140"
+FORMAT_ID_RE = re.compile(r'^[\w.-]+(\+[\w.-]+)?$')
+
+def format_size(fmt):
+    """(bytes, approximate?) for a format, (None, False) if yt-dlp does not know"""
+    if fmt.get('filesize'):
+        return fmt['filesize'], False
+    if fmt.get('filesize_approx'):
+        return fmt['filesize_approx'], True
+    return None, False
+
+def format_ladder(formats):
+    """Compact list of downloadable formats for /api/info, best first.
+    Video-only formats are paired with the best matching audio and need merging."""
+    def has(codec):
+        return codec != 'none'
     
-    errors = []
+    # Storyboards (images) are neither video nor audio
+    formats = [f for f in formats if f.get('format_id') and f.get('ext') != 'mhtml'
+               and (has(f.get('vcodec')) or has(f.get('acodec')))]
+    audio_only = sorted((f for f in formats if not has(f.get('vcodec'))),
+                        key=lambda f: f.get('abr') or f.get('tbr') or 0, reverse=True)
     
-    for config in client_configs:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'skip_download': True,
-            'writesubtitles': False,
-            'writeautomaticsub': False,
-            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'referer': 'https://www.youtube.com/',
-            'extractor_retries': 3,
+    def best_audio(ext):
+        # m4a goes into mp4 without re-encoding, opus/vorbis into webm
+        wanted = 'm4a' if ext == 'mp4' else 'webm'
+        return next((a for a in audio_only if a.get('ext') == wanted), audio_only[0] if audio_only else None)
+    
+    def entry(fmt, audio=None):
+        size, approx = format_size(fmt)
+        result = {
+            'format_id': fmt['format_id'],
+            'ext': fmt.get('ext'),
+            'resolution': f"{fmt['height']}p" if fmt.get('height') else ('audio only' if not has(fmt.get('vcodec')) else fmt.get('resolution')),
+            'fps': fmt.get('fps'),
+            'vcodec': (fmt.get('vcodec') or 'unknown').split('.')[0],
+            'acodec': (fmt.get('acodec') or 'unknown').split('.')[0],
+            'filesize': size,
+            'filesize_approx': approx,
+            'needs_merge': audio is not None,
         }
-        
-        if config:
-            # Handle special case: android_vr without cookies
-            if isinstance(config, dict) and config.get('no_cookies'):
-                # Don't use cookies for this config
-                player_client = config['player_client']
-                ydl_opts['extractor_args'] = {'youtube': {'player_client': player_client}}
+        if audio is not None:
+            audio_size, audio_approx = format_size(audio)
+            result['format_id'] = f"{fmt['format_id']}+{audio['format_id']}"
+            result['acodec'] = (audio.get('acodec') or 'unknown').split('.')[0]
+            result['filesize'] = size + audio_size if size and audio_size else None
+            result['filesize_approx'] = approx or audio_approx
+            # Same container yt-dlp's merger picks
+            if fmt.get('ext') == audio.get('ext') or (fmt.get('ext'), audio.get('ext')) == ('mp4', 'm4a'):
+                result['ext'] = fmt.get('ext')
             else:
-                ydl_opts['extractor_args'] = {'youtube': config}
-        
-        # Only use cookies if not explicitly disabled for this config
-        if has_cookies and (not isinstance(config, dict) or not config.get('no_cookies')):
-            ydl_opts['cookiefile'] = str(cookies_file)
+                result['ext'] = 'mkv'
+        return result
+    
+    video = []
+    for fmt in formats:
+        if not has(fmt.get('vcodec')):
+            continue
+        if has(fmt.get('acodec')):
+            video.append((fmt, entry(fmt)))
+        else:
+            audio = best_audio(fmt.get('ext'))
+            if audio:
+                video.append((fmt, entry(fmt, audio)))
+    video.sort(key=lambda item: (item[0].get('height') or 0, item[0].get('tbr') or 0), reverse=True)
+    return [e for _, e in video] + [entry(f) for f in audio_only]
+
+def get_video_info(url):
+    """Extract video information without downloading"""
+    # Known-dead video - answer without contacting YouTube
+    dead = negative_cache_get(info_cache_key(url))
+    if dead:
+        return {'error': 'Failed to access video. ' + dead}
+    
+    # One account of the cookie pool for this request
+    cookies_file = pick_cookie_account()
+    has_cookies = cookies_file is not None
+    client_configs = client_configs_for(has_cookies)
+    
+    errors = []
+    
+    def attempt(config):
+        started = time.time()
+        ydl_opts = info_ydl_opts(config, has_cookies, cookies_file)
         
         # Try to extract info - handle format errors gracefully
         try:
-            stderr_buffer = io.StringIO()
-            with redirect_stderr(stderr_buffer):
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                    info = ydl.extract_info(url, download=False)
+            # Reused instance - keeps its connections, cookie jar and extractor state
+            with pooled_ydl(ydl_opts) as ydl:
+                info = ydl.extract_info(url, download=False)
+                # Keep the full result so the download can skip a second extraction
+                token = store_extraction(url, config, ydl.sanitize_info(info))
             
             # Successfully extracted info
+            record_client_result(cookies_file, config, True, time.time() - started)
+            observe('ytdl_attempt_seconds', time.time() - started, phase='info', client=client_label(config), outcome='ok')
             formats = info.get('formats', [])
             return {
+                'token': token,
                 'title': info.get('title', 'Unknown'),
                 'duration': info.get('duration', 0),
                 'thumbnail': info.get('thumbnail', ''),
                 'formats': len(formats),
+                'format_ladder': format_ladder(formats),
                 'uploader': info.get('uploader', 'Unknown'),
                 'view_count': info.get('view_count', 0),
             }
         except yt_dlp_utils.DownloadError as e:
             error_msg = str(e)
             # Check if it's a format error - if so, try to get basic info anyway
-            if 'format is not available' in error_msg or 'Requested format' in error_msg:
+            if classify_error(error_msg) == ERROR_FORMAT_MISSING:
                 # Format errors don't prevent us from getting basic metadata
                 # Try with extract_flat or ignore format validation
                 try:
                     # Use extract_flat to bypass format validation
                     flat_opts = ydl_opts.copy()
                     flat_opts['extract_flat'] = True
-                    stderr_buffer = io.StringIO()
-                    with redirect_stderr(stderr_buffer):
-                        with yt_dlp.YoutubeDL(flat_opts) as ydl:
-                            basic_info = ydl.extract_info(url, download=False)
+                    with new_ydl(flat_opts) as ydl:
+                        basic_info = ydl.extract_info(url, download=False)
                     
                     # Got basic info despite format error
+                    record_client_result(cookies_file, config, True, time.time() - started)
                     return {
                         'title': basic_info.get('title', 'Unknown'),
                         'duration': basic_info.get('duration', 0),
                         'thumbnail': basic_info.get('thumbnail', ''),
                         'formats': 0,  # Can't get format count with extract_flat
+                        'format_ladder': [],
                         'uploader': basic_info.get('uploader', 'Unknown'),
                         'view_count': basic_info.get('view_count', 0),
                     }
                 except Exception:
                     # Even extract_flat failed, continue to next config
-                    errors.append(error_msg)
-                    continue
-            else:
-                # Not a format error, add to errors and continue
-                errors.append(error_msg)
-                continue
+                    record_client_failure(cookies_file, config, e)
+                    raise e
+            # Not a format error, continue with the next config (unless the video itself is gone)
+            record_client_failure(cookies_file, config, e)
+            observe('ytdl_attempt_seconds', time.time() - started, phase='info', client=client_label(config), outcome=classify_error(error_msg))
+            raise
         except Exception as e:
-            error_msg = str(e)
-            errors.append(error_msg)
-            # Continue to next config
-            continue
+            record_client_failure(cookies_file, config, e)
+            observe('ytdl_attempt_seconds', time.time() - started, phase='info', client=client_label(config), outcome=classify_error(str(e)))
+            raise
+    
+    # Same client set, but tried in the order that has been working lately.
+    # Slow clients get hedged: the next one starts if no answer arrives within HEDGE_DELAY.
+    started = time.time()
+    config, result = run_hedged(attempt, order_client_configs(client_configs, has_cookies), errors)
+    observe('ytdl_extraction_seconds', time.time() - started, route='info', outcome='ok' if result is not None else 'failed')
+    if result is not None:
+        return result
+    
+    # Private / removed / nonexistent - no point in suggesting cookies, or asking YouTube again soon
+    permanent_summary = permanent_error_summary(errors)
+    if permanent_summary:
+        negative_cache_put(info_cache_key(url), permanent_summary)
+        return {'error': 'Failed to access video. ' + permanent_summary}
     
     # All configs failed - provide helpful error message
     error_summary = 'Failed to access video. '
     
     # Check for specific error types
-    has_bot_error = any('bot' in e.lower() or 'Sign in' in e for e in errors)
-    has_unavailable = any('not available' in e.lower() or 'unavailable' in e.lower() for e in errors)
-    has_private = any('private' in e.lower() or 'unlisted' in e.lower() for e in errors)
+    categories = {classify_error(e) for e in errors}
     
-    if has_bot_error:
+    if ERROR_RATE_LIMITED in categories:
         error_summary += 'YouTube is blocking automated requests. '
-    elif has_unavailable:
+    elif ERROR_AUTH_REQUIRED in categories:
+        error_summary += 'Video may be age-restricted or require sign-in. '
+    elif any('not available' in e.lower() for e in errors):
         error_summary += 'Video may be unavailable or restricted. '
-    elif has_private:
-        error_summary += 'Video may be private or unlisted. '
     
-    if not has_cookies:
+    if not has_cookies and cookie_accounts():
+        error_summary += 'All cookie accounts are cooling down after being rate-limited. Please try again in a few minutes.'
+    elif not has_cookies:
         error_summary += 'COOKIES REQUIRED: Please export cookies from your browser (use extension like "Get cookies.txt LOCALLY") and save as cookies.txt in the project directory. This is essential for accessing YouTube videos.'
     else:
         error_summary += 'Cookies are present but access is still blocked. The video may be region-restricted, age-restricted, or YouTube may be rate-limiting. Try: 1) Refreshing cookies, 2) Waiting a few minutes, 3) Checking if the video is accessible in your browser.'
@@ -162,77 +2291,175 @@ def get_video_info(url):
     
     return {'error': error_summary}
 
-def download_video(url, format_type='best', quality='best'):
-    """Download video with progress tracking"""
-    video_id = url.split('watch?v=')[-1].split('&')[0] if 'watch?v=' in url else 'video'
-    status_key = f"{video_id}_{int(time.time())}"
-    
-    download_status[status_key] = {
-        'status': 'downloading',
+def write_download_status(status_key, entry):
+    get_db().execute(
+        'INSERT OR REPLACE INTO download_status (key, data, updated) VALUES (?, ?, ?)',
+        (status_key, json.dumps(entry, separators=(',', ':')), time.time())
+    )
+
+def read_download_status(status_key):
+    row = get_db().execute(
+        'SELECT data FROM download_status WHERE key = ? AND updated >= ?',
+        (status_key, time.time() - DOWNLOAD_STATUS_TTL)
+    ).fetchone()
+    return json.loads(row[0]) if row else None
+
+def create_download_status(url):
+    """Register a new download and return its status key"""
+    video_id = extract_video_id(url) or 'video'
+    status_key = f"{video_id}_{int(time.time())}_{secrets.token_hex(3)}"
+    entry = {
+        'status': 'queued',
         'progress': 0,
         'filename': '',
-        'error': None
+        'error': None,
+        'speed': None,
+        'eta': None,
+        'version': 0,
     }
+    db = get_db()
+    with download_status_changed:
+        write_download_status(status_key, entry)
+        download_status[status_key] = {'entry': entry, 'flushed': time.time()}
+        download_status_changed.notify_all()
+    
+    # Keep the store bounded: drop stale entries, then the oldest beyond the limit
+    db.execute('DELETE FROM download_status WHERE updated < ?', (time.time() - DOWNLOAD_STATUS_TTL,))
+    db.execute(
+        'DELETE FROM download_status WHERE key IN '
+        '(SELECT key FROM download_status ORDER BY updated DESC LIMIT -1 OFFSET ?)',
+        (DOWNLOAD_STATUS_MAX_ENTRIES,)
+    )
+    return status_key
+
+def update_download_status(status_key, **fields):
+    """Update a download's status and wake up everyone waiting for progress.
+    
+    Progress-hook updates (progress/speed/eta) are coalesced to one write per
+    DOWNLOAD_STATUS_FLUSH_INTERVAL; status, error and filename changes are written at once.
+    """
+    with download_status_changed:
+        local = download_status.get(status_key)
+        entry = local['entry'] if local else read_download_status(status_key)
+        if entry is None:
+            return
+        entry.update(fields)
+        entry['version'] += 1
+        
+        now = time.time()
+        urgent = bool({'status', 'error', 'filename'} & fields.keys())
+        if urgent or not local or now - local['flushed'] >= DOWNLOAD_STATUS_FLUSH_INTERVAL:
+            write_download_status(status_key, entry)
+            local = {'entry': entry, 'flushed': now}
+        if entry['status'] in ('completed', 'error'):
+            # Finished - the database copy is the only one needed now
+            download_status.pop(status_key, None)
+        else:
+            download_status[status_key] = local
+        download_status_changed.notify_all()
+
+def get_download_status(status_key):
+    """Snapshot of a download's status (from any worker), or None if unknown"""
+    with download_status_changed:
+        local = download_status.get(status_key)
+        if local:
+            return dict(local['entry'])
+    return read_download_status(status_key)
+
+def wait_for_download_status(status_key, version, timeout):
+    """Block until the status changes from the given version (or timeout) and return it.
+    
+    Changes made in this worker wake us up immediately; the database is re-read every
+    DOWNLOAD_STATUS_POLL_INTERVAL for downloads running in other workers.
+    """
+    deadline = time.time() + timeout
+    while True:
+        entry = get_download_status(status_key)
+        remaining = deadline - time.time()
+        if entry is None or entry['version'] != version or remaining <= 0:
+            return entry
+        with download_status_changed:
+            download_status_changed.wait(min(remaining, DOWNLOAD_STATUS_POLL_INTERVAL))
+
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='download-job')
+# Running + queued jobs; submissions beyond this are rejected instead of queueing forever
+job_slots = threading.BoundedSemaphore(JOB_WORKERS + JOB_QUEUE_LIMIT)
+
+# Downloads queued by /api/batch get their own pool, so a playlist neither opens dozens of
+# origin connections at once nor fills the queue of single /api/jobs downloads
+batch_download_executor = ThreadPoolExecutor(max_workers=BATCH_DOWNLOAD_WORKERS, thread_name_prefix='batch-download')
+batch_download_slots = threading.BoundedSemaphore(BATCH_DOWNLOAD_WORKERS + BATCH_QUEUE_LIMIT)
+# Metadata lookups of batch entries
+batch_info_executor = ThreadPoolExecutor(max_workers=BATCH_INFO_WORKERS, thread_name_prefix='batch-info')
+
+def submit_download_job(url, format_type='video', quality='best', audio_format='mp3',
+                        executor=job_executor, slots=job_slots, format_id=None):
+    """Queue download_video() on the worker pool. Returns the status key, or None if the queue is full."""
+    if not slots.acquire(blocking=False):
+        return None
+    status_key = create_download_status(url)
+    
+    def run():
+        bandwidth_job = BandwidthJob(status_key, 'job', url)
+        try:
+            download_video(url, format_type, quality, status_key=status_key, audio_format=audio_format,
+                           format_id=format_id, bandwidth_job=bandwidth_job)
+        except Exception as e:
+            update_download_status(status_key, status='error', error=f'Download failed: {str(e)}')
+        finally:
+            bandwidth_job.finish()
+            slots.release()
+    
+    executor.submit(run)
+    return status_key
+
+def download_video(url, format_type='video', quality='best', status_key=None, audio_format='mp3', format_id=None,
+                   bandwidth_job=None):
+    """Download video with progress tracking"""
+    if status_key is None:
+        status_key = create_download_status(url)
+    update_download_status(status_key, status='downloading')
     
     def progress_hook(d):
         if d['status'] == 'downloading':
-            total = d.get('total_bytes') or d.get('total_bytes_estimate', 0)
+            total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
             downloaded = d.get('downloaded_bytes', 0)
+            fields = {'speed': d.get('speed'), 'eta': d.get('eta')}
             if total > 0:
-                progress = (downloaded / total) * 100
-                download_status[status_key]['progress'] = round(progress, 2)
+                fields['progress'] = round((downloaded / total) * 100, 2)
+            update_download_status(status_key, **fields)
         elif d['status'] == 'finished':
-            download_status[status_key]['progress'] = 100
-            download_status[status_key]['status'] = 'completed'
-            download_status[status_key]['filename'] = d.get('filename', '')
+            # Post-processing (e.g. MP3 conversion) may still follow
+            update_download_status(
+                status_key, progress=100, status='processing', speed=None, eta=0,
+                filename=d.get('filename', '')
+            )
     
-    # Check for cookies file
-    cookies_file = Path('cookies.txt')
-    has_cookies = cookies_file.exists()
+    # One account of the cookie pool for this job
+    cookies_file = pick_cookie_account()
+    has_cookies = cookies_file is not None
     
-    # Use the same flow that worked successfully earlier:
-    # android_vr client without cookies + 'best' format
-    # This works reliably without requiring JavaScript runtime or ffmpeg
-    if has_cookies:
-        # Try android_vr first (proven to work), then cookie clients as fallback
-        client_configs = [
-            {'player_client': ['android_vr'], 'no_cookies': True},  # This worked!
-            {},  # Default - yt-dlp will auto-select based on account type
-            {'player_client': ['tv_downgraded', 'web', 'web_safari']},  # Free account fallback
-            {'player_client': ['tv_downgraded', 'web_creator', 'web']},  # Premium account fallback
-            {'player_client': ['web']},
-        ]
-    else:
-        # Without cookies, android_vr works best
-        client_configs = [
-            {'player_client': ['android_vr']},  # This worked! Works without JS runtime
-            {'player_client': ['android_vr', 'web', 'web_safari']},
-            {'player_client': ['web']},
-            {'player_client': ['mweb', 'web']},
-            {},  # No extractor args
-        ]
+    # android_vr first: works reliably without requiring JavaScript runtime or ffmpeg
+    client_configs = client_configs_for(has_cookies, for_download=True)
     
-    # Set format based on user selection - use same flow as successful download
-    # Use 'best' format (single file, no merging needed, no ffmpeg required)
-    format_configs = []
-    if format_type == 'video':
-        if quality == 'best':
-            # Use 'best' format - this worked perfectly (selected format 18)
-            format_configs = ['best']
-        elif quality == '720p':
-            # Try quality-specific single format, fallback to best
-            format_configs = ['best[height<=720]', 'best']
-        elif quality == '480p':
-            format_configs = ['best[height<=480]', 'best']
-        elif quality == '360p':
-            format_configs = ['best[height<=360]', 'best']
-    elif format_type == 'audio':
-        format_configs = ['bestaudio/best', 'best']
+    format_configs, audio_postprocessor = download_formats(format_type, quality, audio_format, format_id)
     
     errors = []
+    tried = 0
+    
+    # Known-dead video - fail without contacting YouTube
+    dead = negative_cache_get(info_cache_key(url))
+    if dead:
+        update_download_status(status_key, status='error', error='Failed to download video. ' + dead)
+        return status_key
     
-    for config in client_configs:
+    for config in order_client_configs(client_configs, has_cookies):
+        if any(is_permanent_error(e) for e in errors):
+            # Private / removed video - no other client will do better
+            break
         for format_str in format_configs:
+            tried += 1
+            started = time.time()
             ydl_opts = {
                 'outtmpl': str(DOWNLOADS_DIR / '%(title)s.%(ext)s'),
                 'progress_hooks': [progress_hook],
@@ -242,81 +2469,85 @@ def download_video(url, format_type='best', quality='best'):
                 'format': format_str,
             }
             
-            if format_type == 'audio':
-                ydl_opts['postprocessors'] = [{
-                    'key': 'FFmpegExtractAudio',
-                    'preferredcodec': 'mp3',
-                    'preferredquality': '192',
-                }]
+            if audio_postprocessor:
+                ydl_opts['postprocessors'] = [dict(audio_postprocessor)]
             
-            if config:
-                # Handle special case: android_vr without cookies
-                if isinstance(config, dict) and config.get('no_cookies'):
-                    # Don't use cookies for this config
-                    player_client = config['player_client']
-                    ydl_opts['extractor_args'] = {'youtube': {'player_client': player_client}}
-                else:
-                    ydl_opts['extractor_args'] = {'youtube': config}
-            
-            # Only use cookies if not explicitly disabled for this config
-            if has_cookies and (not isinstance(config, dict) or not config.get('no_cookies')):
-                ydl_opts['cookiefile'] = str(cookies_file)
+            apply_client_config(ydl_opts, config, has_cookies, cookies_file)
             
             try:
-                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                with create_downloader(ydl_opts, bandwidth_job, index_downloads=True) as ydl:
                     ydl.download([url])
-                download_status[status_key]['status'] = 'completed'
+                record_client_result(cookies_file, config, True, time.time() - started)
+                record_download_win('job', config, started, tried)
+                update_download_status(status_key, status='completed')
                 return status_key
             except yt_dlp_utils.DownloadError as e:
                 error_msg = str(e)
                 errors.append(error_msg)
+                category = classify_error(error_msg)
+                observe('ytdl_attempt_seconds', time.time() - started, phase='job', client=client_label(config), outcome=category)
                 # Check if it's an ffmpeg merging error - fallback to single format
-                if 'ffmpeg' in error_msg.lower() and 'merging' in error_msg.lower():
+                if 'ffmpeg' in error_msg.lower() and 'merging' in error_msg.lower() and not format_id:
                     # Try with single format that doesn't require merging
                     try:
                         ydl_opts['format'] = 'best'
-                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                        with create_downloader(ydl_opts, bandwidth_job, index_downloads=True) as ydl:
                             ydl.download([url])
-                        download_status[status_key]['status'] = 'completed'
+                        record_client_result(cookies_file, config, True, time.time() - started)
+                        record_download_win('job', config, started, tried)
+                        update_download_status(status_key, status='completed')
                         return status_key
                     except:
                         pass
                 # Check if it's because only images/storyboards are available
-                if 'Only images are available' in error_msg or 'storyboard' in error_msg.lower():
+                if ('Only images are available' in error_msg or 'storyboard' in error_msg.lower()) and not format_id:
                     # Try with a more permissive format selector
                     try:
                         ydl_opts['format'] = 'best[ext=mp4]/best[height<=360]/best'
-                        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                        with create_downloader(ydl_opts, bandwidth_job, index_downloads=True) as ydl:
                             ydl.download([url])
-                        download_status[status_key]['status'] = 'completed'
+                        record_client_result(cookies_file, config, True, time.time() - started)
+                        record_download_win('job', config, started, tried)
+                        update_download_status(status_key, status='completed')
                         return status_key
                     except:
                         pass
                 # If format error, try next format
-                if 'format is not available' in error_msg or 'Requested format' in error_msg:
+                if category == ERROR_FORMAT_MISSING:
                     continue
                 # Otherwise, try next config
+                record_client_failure(cookies_file, config, error_msg)
                 break
             except Exception as e:
                 error_msg = str(e)
                 errors.append(error_msg)
+                observe('ytdl_attempt_seconds', time.time() - started, phase='job', client=client_label(config), outcome=classify_error(error_msg))
                 # If format error, try next format
-                if 'format is not available' in error_msg or 'Requested format' in error_msg:
+                if classify_error(error_msg) == ERROR_FORMAT_MISSING:
                     continue
                 # Otherwise, try next config
+                record_client_failure(cookies_file, config, error_msg)
                 break
     
+    observe('ytdl_download_attempts', tried, route='job', outcome='failed')
+    permanent_summary = permanent_error_summary(errors)
+    if permanent_summary:
+        negative_cache_put(info_cache_key(url), permanent_summary)
+        update_download_status(status_key, status='error', error='Failed to download video. ' + permanent_summary)
+        return status_key
+    
     # All configs failed - provide helpful error message
-    download_status[status_key]['status'] = 'error'
     error_summary = 'Failed to download video. '
-    if any('bot' in e.lower() or 'Sign in' in e for e in errors):
+    if any(classify_error(e) == ERROR_RATE_LIMITED for e in errors):
         error_summary += 'YouTube is blocking automated requests. '
-    if not has_cookies:
+    if not has_cookies and cookie_accounts():
+        error_summary += 'All cookie accounts are cooling down after being rate-limited. Please try again in a few minutes.'
+    elif not has_cookies:
         error_summary += 'COOKIES REQUIRED: Please export cookies from your browser (use extension like "Get cookies.txt LOCALLY") and save as cookies.txt in the project directory. This is essential for accessing YouTube videos.'
     else:
         error_summary += 'Even with cookies, YouTube may be blocking access. Try updating yt-dlp: pip install -U yt-dlp'
     
-    download_status[status_key]['error'] = error_summary
+    update_download_status(status_key, status='error', error=error_summary)
     return status_key
 
 @app.route('/')
@@ -331,220 +2562,800 @@ def get_info():
     if not url:
         return jsonify({'error': 'URL is required'}), 400
     
-    info = get_video_info(url)
-    return jsonify(info)
+    return jsonify(lookup_info(url))
+
+def lookup_info(url):
+    """Metadata for /api/info: from the cache, or extracted (and cached if successful)"""
+    cache_key = info_cache_key(url)
+    info = info_cache_get(cache_key)
+    if info is None:
+        info = get_video_info(url)
+        # Only successful lookups are cached - errors are often temporary
+        if 'error' not in info:
+            # Tokens are short-lived, so they are not part of the cached metadata
+            info_cache_put(cache_key, {k: v for k, v in info.items() if k != 'token'})
+    else:
+        token = latest_extraction_token(cache_key)
+        if token:
+            info['token'] = token
+    return info
+
+@app.route('/api/cache/stats')
+def cache_stats():
+    return jsonify({
+        'info_cache': info_cache_stats(),
+        'result_cache': result_cache_stats(),
+        'temp_storage': temp_storage_stats(),
+        'negative_cache': {'hits': read_counters('negative_cache.').get('hits', 0), 'ttl': NEGATIVE_CACHE_TTL},
+    })
+
+@app.route('/api/clients/stats')
+def clients_stats():
+    """Decayed success rate / average latency per player client config, as used for ordering"""
+    return jsonify({
+        mode: [
+            {'config': json.loads(key), 'success_rate': round(rate, 4), 'latency': latency}
+            for key, (rate, latency) in client_stats(mode == 'cookies').items()
+        ]
+        for mode in ('cookies', 'no_cookies')
+    })
+
+@app.route('/api/cookies/stats')
+def cookies_stats():
+    """Health of the cookie account pool"""
+    counters = read_counters('cookies.')
+    return jsonify({
+        'accounts': cookie_account_stats(),
+        'throttled': counters.get('throttled', 0),
+        'all_cooling': counters.get('all_cooling', 0),
+    })
+
+@app.route('/api/bandwidth')
+def bandwidth_stats():
+    """Current bandwidth and fragment allocation of every active download"""
+    return jsonify({
+        'limit': BANDWIDTH_LIMIT or None,
+        'fragment_budget': FRAGMENT_BUDGET,
+        # Job ids are status keys / cache keys - only show a stand-in for them
+        'downloads': [dict(allocation, id=opaque_id(job_id)) for job_id, allocation in bandwidth_allocations().items()],
+    })
+
+@app.route('/api/ffmpeg/stats')
+def ffmpeg_stats():
+    """FFmpeg admission queue of this worker, plus job counters across all workers"""
+    return jsonify(dict(ffmpeg_gate.stats(), pid=os.getpid(), **read_counters('ffmpeg.')))
+
+def record_download_win(route, config, started, tried):
+    """Metrics for a download request that succeeded: the winning attempt, attempts used, winning client"""
+    observe('ytdl_attempt_seconds', time.time() - started, phase=route, client=client_label(config), outcome='ok')
+    observe('ytdl_download_attempts', tried, route=route, outcome='ok')
+    bump_counter(f'{route}.wins.{client_label(config)}')
+
+def download_failed(url, errors):
+    """Error response once every download attempt failed"""
+    permanent_summary = permanent_error_summary(errors)
+    if permanent_summary:
+        negative_cache_put(info_cache_key(url), permanent_summary)
+        return jsonify({'error': 'Failed to download video. ' + permanent_summary}), 404
+    return jsonify({'error': 'Failed to download video. Please try again.'}), 500
+
+def validate_download_request(data):
+    """Error message for an invalid download request, or None"""
+    if not isinstance(data, dict):
+        return 'Request body must be a JSON object'
+    if not data.get('url'):
+        return 'URL is required'
+    for field in ('url', 'token'):
+        if data.get(field) is not None and not isinstance(data[field], str):
+            return f'{field} must be a string'
+    return validate_download_options(data)
+
+def validate_download_options(data):
+    """Error message for invalid format options, or None"""
+    for field in ('format', 'quality', 'audio_format', 'format_id'):
+        if data.get(field) is not None and not isinstance(data[field], str):
+            return f'{field} must be a string'
+    if data.get('format', 'video') not in DOWNLOAD_FORMATS:
+        return f'format must be one of: {", ".join(DOWNLOAD_FORMATS)}'
+    if data.get('quality', 'best') not in VIDEO_QUALITIES:
+        return f'quality must be one of: {", ".join(VIDEO_QUALITIES)}'
+    if data.get('audio_format', 'mp3') not in AUDIO_FORMATS:
+        return f'audio_format must be one of: {", ".join(AUDIO_FORMATS)}'
+    if data.get('format_id') and not FORMAT_ID_RE.match(data['format_id']):
+        return 'Invalid format_id'
+    return None
+
+def temp_storage_full():
+    """503 for downloads that don't fit TEMP_QUOTA_BYTES right now"""
+    return jsonify({'error': 'Server is busy with other downloads. Please try again shortly.'}), 503, {'Retry-After': '30'}
 
 @app.route('/api/download', methods=['POST'])
 def download():
-    """Stream download directly to user - no server storage"""
+    """Stream download directly to user - identical requests share one cached download"""
+    data = request.json
+    error = validate_download_request(data)
+    if error:
+        return jsonify({'error': error}), 400
+    return stream_download(data)
+
+download_token_secret = None
+
+def get_download_token_secret():
+    """HMAC key for download tokens - DOWNLOAD_TOKEN_SECRET, or one generated once per state DB"""
+    global download_token_secret
+    if download_token_secret is None:
+        if DOWNLOAD_TOKEN_SECRET:
+            download_token_secret = DOWNLOAD_TOKEN_SECRET.encode()
+        else:
+            # Shared through the state DB, so every worker accepts every worker's tokens
+            db = get_db()
+            db.execute('INSERT OR IGNORE INTO settings (name, value) VALUES (?, ?)',
+                       ('download_token_secret', secrets.token_hex(32)))
+            value, = db.execute("SELECT value FROM settings WHERE name = 'download_token_secret'").fetchone()
+            download_token_secret = value.encode()
+    return download_token_secret
+
+def opaque_id(value):
+    """Stable stand-in for an internal name (a cookie file path, a job's status key) in public stats"""
+    return hmac.new(get_download_token_secret(), value.encode(), hashlib.sha256).hexdigest()[:12]
+
+def sign_download_token(data):
+    """URL-safe token carrying the download options, valid for DOWNLOAD_TOKEN_TTL seconds"""
+    payload = dict(data, exp=int(time.time()) + DOWNLOAD_TOKEN_TTL)
+    body = base64.urlsafe_b64encode(json.dumps(payload, separators=(',', ':')).encode()).rstrip(b'=')
+    signature = hmac.new(get_download_token_secret(), body, hashlib.sha256).digest()
+    return (body + b'.' + base64.urlsafe_b64encode(signature).rstrip(b'=')).decode()
+
+def verify_download_token(token):
+    """(download options, expired?) for a token we signed, (None, False) otherwise"""
+    body, _, signature = token.encode().partition(b'.')
+    expected = base64.urlsafe_b64encode(
+        hmac.new(get_download_token_secret(), body, hashlib.sha256).digest()
+    ).rstrip(b'=')
+    if not hmac.compare_digest(signature, expected):
+        return None, False
+    data = json.loads(base64.urlsafe_b64decode(body + b'=' * (-len(body) % 4)))
+    return data, data.pop('exp') < time.time()
+
+@app.route('/api/download-token', methods=['POST'])
+def create_download_token():
+    """Short-lived link for /api/download's options, so the browser can download natively"""
     data = request.json
+    error = validate_download_request(data)
+    if error:
+        return jsonify({'error': error}), 400
+    # Answer what's known to fail now - once the browser follows the link, an error becomes a saved file
+    dead = negative_cache_get(info_cache_key(data['url']))
+    if dead:
+        return jsonify({'error': 'Failed to download video. ' + dead}), 404
+    format_configs, audio_postprocessor = download_formats(
+        data.get('format', 'video'), data.get('quality', 'best'), data.get('audio_format', 'mp3'), data.get('format_id')
+    )
+    postprocessors = [audio_postprocessor] if audio_postprocessor else []
+    _, cached = lookup_result_alias(result_alias(data['url'], format_configs[0], postprocessors))
+    if not cached and not temp_space_available():
+        return temp_storage_full()
+    token = sign_download_token({
+        key: data[key] for key in ('url', 'format', 'quality', 'audio_format', 'format_id', 'token')
+        if data.get(key)
+    })
+    return jsonify({
+        'download_url': f'/api/download/{token}',
+        'expires_in': DOWNLOAD_TOKEN_TTL,
+    })
+
+@app.route('/api/download/<token>')
+def download_by_token(token):
+    """GET version of /api/download - the browser streams it to disk and can resume it"""
+    data, expired = verify_download_token(token)
+    if data is None:
+        return jsonify({'error': 'Invalid download link'}), 403
+    if request.method == 'HEAD' or (expired and request.range):
+        # Download managers probe with HEAD, which must not start a download; resuming one that
+        # has finished in the meantime needs no new work
+        response = stream_download(data, cached_only=True)
+        if response is not None:
+            return response
+        if not expired:
+            # Name and size aren't known before the download starts (an iterable body sends no Content-Length)
+            return Response(iter(()), mimetype='application/octet-stream', headers={'Accept-Ranges': 'bytes'})
+    if expired:
+        return jsonify({'error': 'Download link expired. Please start the download again.'}), 410
+    return stream_download(data)
+
+def stream_download(data, cached_only=False):
+    """Response for validated download options (/api/download and signed download links).
+    With cached_only, None unless the result is already cached."""
     url = data.get('url', '')
-    format_type = data.get('format', 'best')
+    format_type = data.get('format', 'video')
     quality = data.get('quality', 'best')
+    audio_format = data.get('audio_format', 'mp3')
+    format_id = data.get('format_id')
     
-    if not url:
-        return jsonify({'error': 'URL is required'}), 400
-    
-    # Create temporary directory for this download
-    temp_dir = tempfile.mkdtemp()
-    temp_file = None
+    # Known-dead video - answer without contacting YouTube
+    dead = negative_cache_get(info_cache_key(url))
+    if dead:
+        return jsonify({'error': 'Failed to download video. ' + dead}), 404
     
     try:
-        cookies_file = Path('cookies.txt')
-        has_cookies = cookies_file.exists()
+        cookies_file = pick_cookie_account()
+        has_cookies = cookies_file is not None
         
-        # Use the same flow that worked successfully
-        if has_cookies:
-            client_configs = [
-                {'player_client': ['android_vr'], 'no_cookies': True},
-                {},  # Default
-                {'player_client': ['tv_downgraded', 'web', 'web_safari']},
-                {'player_client': ['tv_downgraded', 'web_creator', 'web']},
-                {'player_client': ['web']},
-            ]
-        else:
-            client_configs = [
-                {'player_client': ['android_vr']},
-                {'player_client': ['android_vr', 'web', 'web_safari']},
-                {'player_client': ['web']},
-                {'player_client': ['mweb', 'web']},
-                {},
-            ]
+        client_configs = client_configs_for(has_cookies, for_download=True)
         
-        # Set format
-        format_configs = []
-        if format_type == 'video':
-            if quality == 'best':
-                format_configs = ['best']
-            elif quality == '720p':
-                format_configs = ['best[height<=720]', 'best']
-            elif quality == '480p':
-                format_configs = ['best[height<=480]', 'best']
-            elif quality == '360p':
-                format_configs = ['best[height<=360]', 'best']
-        elif format_type == 'audio':
-            format_configs = ['bestaudio/best', 'best']
+        format_configs, audio_postprocessor = download_formats(format_type, quality, audio_format, format_id)
+        
+        # Repeat request for something already cached - no need to contact YouTube at all
+        postprocessors = [audio_postprocessor] if audio_postprocessor else []
+        cached = serve_cached_request(url, format_configs[0], postprocessors)
+        if cached or cached_only:
+            return cached
+        # Refuse up front rather than after extracting, if there's no room for another download
+        if not temp_space_available():
+            return temp_storage_full()
+        
+        # Reuse the extraction /api/info already did, if the client sent its token.
+        # Its client config is tried first, without contacting YouTube for metadata again.
+        extraction = load_extraction(data.get('token'), url)
+        client_configs = order_client_configs(client_configs, has_cookies)
+        attempts = []
+        if extraction:
+            attempts.append((extraction['config'], extraction['info']))
+        elif HEDGE_FANOUT > 1:
+            # Extract with hedging across clients, then download from the winner's result
+            errors = []
+            started = time.time()
+            config, info = run_hedged(
+                lambda config: extract_raw_info(url, config, has_cookies, cookies_file), client_configs, errors
+            )
+            observe('ytdl_extraction_seconds', time.time() - started, route='download', outcome='ok' if info is not None else 'failed')
+            if info is None:
+                return download_failed(url, errors)
+            attempts.append((config, info))
+            # The other clients stay as fallbacks if the download itself fails
+            client_configs = [c for c in client_configs if c != config]
+        attempts.extend((config, None) for config in client_configs)
         
         # Try to download
-        for config in client_configs:
+        errors = []
+        tried = 0
+        for config, info in attempts:
+            if any(is_permanent_error(e) for e in errors):
+                # Private / removed video - no other client will do better
+                break
             for format_str in format_configs:
+                tried += 1
                 ydl_opts = {
-                    'outtmpl': str(Path(temp_dir) / '%(title)s.%(ext)s'),
                     'quiet': False,
                     'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
                     'referer': 'https://www.youtube.com/',
                     'format': format_str,
                 }
                 
-                if format_type == 'audio':
-                    ydl_opts['postprocessors'] = [{
-                        'key': 'FFmpegExtractAudio',
-                        'preferredcodec': 'mp3',
-                        'preferredquality': '192',
-                    }]
-                
-                if config:
-                    if isinstance(config, dict) and config.get('no_cookies'):
-                        player_client = config['player_client']
-                        ydl_opts['extractor_args'] = {'youtube': {'player_client': player_client}}
-                    else:
-                        ydl_opts['extractor_args'] = {'youtube': config}
+                if audio_postprocessor:
+                    # Skipped at download time if the source already has the requested codec
+                    ydl_opts['postprocessors'] = [dict(audio_postprocessor)]
                 
-                if has_cookies and (not isinstance(config, dict) or not config.get('no_cookies')):
-                    ydl_opts['cookiefile'] = str(cookies_file)
+                apply_client_config(ydl_opts, config, has_cookies, cookies_file)
                 
+                started = time.time()
                 try:
-                    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                        ydl.download([url])
-                    
-                    # Find the downloaded file
-                    downloaded_files = list(Path(temp_dir).glob('*'))
-                    if downloaded_files:
-                        temp_file = downloaded_files[0]
-                        filename = temp_file.name
-                        
-                        # Stream the file to user
-                        def generate():
-                            try:
-                                with open(temp_file, 'rb') as f:
-                                    while True:
-                                        chunk = f.read(8192)  # 8KB chunks
-                                        if not chunk:
-                                            break
-                                        yield chunk
-                            finally:
-                                # Clean up temporary file and directory
-                                try:
-                                    if temp_file and temp_file.exists():
-                                        temp_file.unlink()
-                                    if os.path.exists(temp_dir):
-                                        shutil.rmtree(temp_dir)
-                                except:
-                                    pass
-                        
-                        # Determine content type
-                        ext = temp_file.suffix.lower()
-                        content_type = 'video/mp4' if ext == '.mp4' else 'audio/mpeg' if ext == '.mp3' else 'application/octet-stream'
-                        
-                        return Response(
-                            stream_with_context(generate()),
-                            mimetype=content_type,
-                            headers={
-                                'Content-Disposition': f'attachment; filename="{filename}"',
-                                'Content-Length': str(temp_file.stat().st_size)
-                            }
-                        )
+                    # Identical concurrent requests share one download; finished ones are cached
+                    response = download_through_cache(ydl_opts, url, info, format_str)
+                    record_client_result(cookies_file, config, True, time.time() - started)
+                    record_download_win('download', config, started, tried)
+                    return response
+                except (TempQuotaExceeded, DownloadProducedNoFile):
+                    raise
                 except Exception as e:
                     error_msg = str(e)
-                    if 'format is not available' in error_msg or 'Requested format' in error_msg:
+                    errors.append(error_msg)
+                    observe('ytdl_attempt_seconds', time.time() - started, phase='download', client=client_label(config), outcome=classify_error(error_msg))
+                    if classify_error(error_msg) == ERROR_FORMAT_MISSING and 'merging' not in error_msg.lower():
                         continue
-                    if 'ffmpeg' in error_msg.lower() and 'merging' in error_msg.lower():
+                    if 'ffmpeg' in error_msg.lower() and 'merging' in error_msg.lower() and not format_id:
                         try:
                             ydl_opts['format'] = 'best'
-                            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                                ydl.download([url])
-                            downloaded_files = list(Path(temp_dir).glob('*'))
-                            if downloaded_files:
-                                temp_file = downloaded_files[0]
-                                filename = temp_file.name
-                                def generate():
-                                    try:
-                                        with open(temp_file, 'rb') as f:
-                                            while True:
-                                                chunk = f.read(8192)
-                                                if not chunk:
-                                                    break
-                                                yield chunk
-                                    finally:
-                                        try:
-                                            if temp_file and temp_file.exists():
-                                                temp_file.unlink()
-                                            if os.path.exists(temp_dir):
-                                                shutil.rmtree(temp_dir)
-                                        except:
-                                            pass
-                                ext = temp_file.suffix.lower()
-                                content_type = 'video/mp4' if ext == '.mp4' else 'audio/mpeg' if ext == '.mp3' else 'application/octet-stream'
-                                return Response(
-                                    stream_with_context(generate()),
-                                    mimetype=content_type,
-                                    headers={
-                                        'Content-Disposition': f'attachment; filename="{filename}"',
-                                        'Content-Length': str(temp_file.stat().st_size)
-                                    }
-                                )
+                            tried += 1
+                            started = time.time()
+                            response = download_through_cache(ydl_opts, url, info, 'best')
+                            record_client_result(cookies_file, config, True, time.time() - started)
+                            record_download_win('download', config, started, tried)
+                            return response
                         except:
                             pass
+                    record_client_failure(cookies_file, config, error_msg)
                     break
         
-        # Cleanup on error
-        try:
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
-        except:
-            pass
-        
-        return jsonify({'error': 'Failed to download video. Please try again.'}), 500
+        observe('ytdl_download_attempts', tried, route='download', outcome='failed')
+        return download_failed(url, errors)
         
+    except TempQuotaExceeded:
+        return temp_storage_full()
     except Exception as e:
-        # Cleanup on exception
-        try:
-            if temp_file and temp_file.exists():
-                temp_file.unlink()
-            if os.path.exists(temp_dir):
-                shutil.rmtree(temp_dir)
-        except:
-            pass
         return jsonify({'error': f'Download failed: {str(e)}'}), 500
 
 @app.route('/api/status/<status_key>')
 def get_status(status_key):
-    if status_key in download_status:
-        return jsonify(download_status[status_key])
+    status = get_download_status(status_key)
+    if status:
+        return jsonify(status)
     return jsonify({'error': 'Status not found'}), 404
 
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """Queue a server-side download and return its status key immediately"""
+    data = request.json
+    error = validate_download_request(data)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    status_key = submit_download_job(data['url'], data.get('format', 'video'), data.get('quality', 'best'),
+                                     data.get('audio_format', 'mp3'), format_id=data.get('format_id'))
+    if status_key is None:
+        return jsonify({'error': 'Too many downloads in progress. Please try again shortly.'}), 503, {'Retry-After': '30'}
+    return jsonify({
+        'status_key': status_key,
+        'status_url': f'/api/status/{status_key}',
+        'events_url': f'/api/jobs/{status_key}/events',
+    }), 202
+
+def expand_batch_urls(urls, limit):
+    """Yield (url, error) for the videos of a batch: video URLs as given, playlists and channels
+    expanded with a flat extraction (one request per page of entries, no per-video lookups)"""
+    count = 0
+    for url in urls:
+        if count >= limit:
+            return
+        if extract_video_id(url):
+            count += 1
+            yield url, None
+            continue
+        
+        ydl_opts = {
+            'quiet': True,
+            'no_warnings': True,
+            'logger': SILENT_LOGGER,
+            'extract_flat': 'in_playlist',
+            'playlistend': limit - count,
+            'user_agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+        }
+        cookies_file = pick_cookie_account()
+        if cookies_file:
+            ydl_opts['cookiefile'] = str(cookies_file)
+        try:
+            with new_ydl(ydl_opts) as ydl:
+                result = ydl.extract_info(url, download=False)
+        except Exception as e:
+            count += 1
+            yield url, str(e)
+            continue
+        
+        if result.get('_type') not in ('playlist', 'multi_video'):
+            # Not a playlist after all - a single video on another URL form
+            count += 1
+            yield url, None
+            continue
+        for entry in result.get('entries') or []:
+            if count >= limit:
+                return
+            if not entry:
+                continue
+            entry_url = entry.get('url') or entry.get('webpage_url')
+            if entry.get('ie_key') == 'Youtube' or not entry_url:
+                entry_url = f"https://www.youtube.com/watch?v={entry['id']}"
+            count += 1
+            yield entry_url, None
+
+@app.route('/api/batch', methods=['POST'])
+def batch():
+    """Metadata for many URLs and/or playlists, streamed as NDJSON lines as each lookup finishes.
+    
+    With a "download" object ({"format", "quality", "audio_format"}), each video that resolves is
+    also queued for a server-side download; its line then carries a status_key.
+    """
+    data = request.json
+    urls = data.get('urls') or []
+    if not isinstance(urls, list) or not all(isinstance(url, str) and url for url in urls):
+        return jsonify({'error': 'urls must be a list of URL strings'}), 400
+    urls = list(urls)
+    if data.get('url'):
+        if not isinstance(data['url'], str):
+            return jsonify({'error': 'url must be a string'}), 400
+        urls.append(data['url'])
+    if not urls:
+        return jsonify({'error': 'URL is required'}), 400
+    if len(urls) > BATCH_MAX_ENTRIES:
+        return jsonify({'error': f'At most {BATCH_MAX_ENTRIES} URLs per batch'}), 400
+    
+    download_opts = data.get('download')
+    if download_opts is not None:
+        if not isinstance(download_opts, dict):
+            return jsonify({'error': 'download must be an object'}), 400
+        error = validate_download_options(download_opts)
+        if error:
+            return jsonify({'error': error}), 400
+    
+    def resolve(index, url, error):
+        line = {'index': index, 'url': url}
+        if error is None:
+            info = lookup_info(url)
+            error = info.pop('error', None)
+            line['info'] = info
+        if error is not None:
+            line['error'] = error
+        elif download_opts is not None:
+            status_key = submit_download_job(
+                url, download_opts.get('format', 'video'), download_opts.get('quality', 'best'),
+                download_opts.get('audio_format', 'mp3'),
+                executor=batch_download_executor, slots=batch_download_slots,
+            )
+            if status_key:
+                line['status_key'] = status_key
+            else:
+                line['error'] = 'Too many downloads queued. Please try again shortly.'
+        return line
+    
+    def generate():
+        pending = set()
+        counts = {'entries': 0, 'failed': 0}
+        
+        def lines(futures):
+            for future in futures:
+                line = future.result()
+                counts['failed'] += 'error' in line
+                yield json.dumps(line) + '\n'
+        
+        try:
+            for index, (url, error) in enumerate(expand_batch_urls(urls, BATCH_MAX_ENTRIES)):
+                counts['entries'] += 1
+                pending.add(batch_info_executor.submit(resolve, index, url, error))
+                # Send whatever already finished while the playlist is still being expanded
+                done = {future for future in pending if future.done()}
+                pending -= done
+                yield from lines(done)
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from lines(done)
+            yield json.dumps({'done': True, **counts}) + '\n'
+        finally:
+            # Client went away - skip lookups that haven't started
+            for future in pending:
+                future.cancel()
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/api/jobs/<status_key>/events')
+def job_events(status_key):
+    """Server-Sent Events stream of a job's progress (speed in bytes/s, ETA in seconds)"""
+    if get_download_status(status_key) is None:
+        return jsonify({'error': 'Status not found'}), 404
+    
+    def generate():
+        version = None
+        deadline = time.time() + JOB_EVENTS_MAX_DURATION
+        while time.time() < deadline:
+            status = wait_for_download_status(status_key, version, timeout=15)
+            if status is None:
+                break
+            if status['version'] == version:
+                # Keep proxies from closing an idle connection
+                yield ': keep-alive\n\n'
+                continue
+            version = status['version']
+            yield f'data: {json.dumps(status)}\n\n'
+            if status['status'] in ('completed', 'error'):
+                break
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def index_download(path, video_id=None, format_id=None):
+    """Add (or refresh) one file of DOWNLOADS_DIR in the downloads index"""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return
+    get_db().execute(
+        'INSERT INTO downloads_index (name, size, mtime_ns, video_id, format) VALUES (?, ?, ?, ?, ?) '
+        'ON CONFLICT(name) DO UPDATE SET size = excluded.size, mtime_ns = excluded.mtime_ns, '
+        'video_id = COALESCE(excluded.video_id, video_id), format = COALESCE(excluded.format, format)',
+        (path.name, stat.st_size, stat.st_mtime_ns, video_id, format_id)
+    )
+
+def reconcile_downloads_index():
+    """Bring the index in line with DOWNLOADS_DIR: files added, changed or deleted outside of jobs"""
+    db = get_db()
+    indexed = {name: (size, mtime_ns) for name, size, mtime_ns in
+               db.execute('SELECT name, size, mtime_ns FROM downloads_index')}
+    present = set()
+    with os.scandir(DOWNLOADS_DIR) as entries:
+        for entry in entries:
+            # yt-dlp's unfinished files - indexed once complete
+            if not entry.is_file() or entry.name.endswith(('.part', '.ytdl')):
+                continue
+            present.add(entry.name)
+            stat = entry.stat()
+            if indexed.get(entry.name) != (stat.st_size, stat.st_mtime_ns):
+                index_download(Path(entry.path))
+    for name in indexed.keys() - present:
+        db.execute('DELETE FROM downloads_index WHERE name = ?', (name,))
+
+def downloads_indexer():
+    """Background loop: reconcile the index every DOWNLOADS_SCAN_INTERVAL, shared by all workers"""
+    while True:
+        try:
+            db = get_db()
+            now = time.time()
+            # Claim the scan - whichever worker gets here first does it
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                row = db.execute("SELECT value FROM settings WHERE name = 'downloads_scanned'").fetchone()
+                due = row is None or now - float(row[0]) >= DOWNLOADS_SCAN_INTERVAL
+                if due:
+                    db.execute("INSERT OR REPLACE INTO settings (name, value) VALUES ('downloads_scanned', ?)", (str(now),))
+                db.execute('COMMIT')
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            if due:
+                reconcile_downloads_index()
+        except Exception:
+            pass
+        time.sleep(min(DOWNLOADS_SCAN_INTERVAL, 60))
+
+# Sort keys of /api/downloads -> index column
+DOWNLOADS_SORT_COLUMNS = {'mtime': 'mtime_ns', 'size': 'size', 'name': 'name'}
+
+def cursor_value_valid(column, value):
+    """True if value can be compared with the sort column (a string for name, an SQLite integer otherwise)"""
+    if column == 'name':
+        return isinstance(value, str)
+    return isinstance(value, int) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63
+
 @app.route('/api/downloads')
 def list_downloads():
-    """List all downloaded files (for local use only - not used in streaming mode)"""
-    files = []
-    for file_path in DOWNLOADS_DIR.glob('*'):
-        if file_path.is_file():
-            files.append({
-                'name': file_path.name,
-                'size': file_path.stat().st_size,
-                'path': str(file_path)
-            })
-    return jsonify({'files': files})
+    """Downloaded files from the index (for local use only - not used in streaming mode).
+    
+    Query: sort=mtime|size|name, order=desc|asc, limit, cursor (next_cursor of the previous page),
+    q (name contains), video_id, format.
+    """
+    sort = request.args.get('sort', 'mtime')
+    order = request.args.get('order', 'desc')
+    if sort not in DOWNLOADS_SORT_COLUMNS or order not in ('asc', 'desc'):
+        return jsonify({'error': f'sort must be one of: {", ".join(DOWNLOADS_SORT_COLUMNS)}; order asc or desc'}), 400
+    limit = min(max(request.args.get('limit', DOWNLOADS_PAGE_SIZE, type=int), 1), DOWNLOADS_PAGE_SIZE_MAX)
+    column = DOWNLOADS_SORT_COLUMNS[sort]
+    
+    where, params = [], []
+    if request.args.get('q'):
+        where.append('instr(lower(name), lower(?)) > 0')
+        params.append(request.args['q'])
+    for field in ('video_id', 'format'):
+        if request.args.get(field):
+            where.append(f'{field} = ?')
+            params.append(request.args[field])
+    cursor = request.args.get('cursor')
+    if cursor:
+        # Keyset pagination: continue after the last row of the previous page
+        try:
+            after = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except ValueError:
+            after = None
+        if not (isinstance(after, list) and len(after) == 2 and isinstance(after[1], str)
+                and cursor_value_valid(column, after[0])):
+            return jsonify({'error': 'Invalid cursor'}), 400
+        where.append(f"({column}, name) {'<' if order == 'desc' else '>'} (?, ?)")
+        params.extend(after)
+    
+    rows = get_db().execute(
+        f'SELECT name, size, mtime_ns, video_id, format FROM downloads_index '
+        f"{'WHERE ' + ' AND '.join(where) if where else ''} "
+        f'ORDER BY {column} {order}, name {order} LIMIT ?',
+        params + [limit + 1]
+    ).fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = dict(zip(('name', 'size', 'mtime_ns'), rows[-1]))
+        next_cursor = base64.urlsafe_b64encode(
+            json.dumps([last[column], last['name']]).encode()
+        ).rstrip(b'=').decode()
+    files = [{
+        'name': name,
+        'size': size,
+        'mtime': mtime_ns / 1e9,
+        'video_id': video_id,
+        'format': format_id,
+        'path': str(DOWNLOADS_DIR / name),
+    } for name, size, mtime_ns, video_id, format_id in rows]
+    return jsonify({'files': files, 'next_cursor': next_cursor})
 
 @app.route('/api/download-file/<filename>')
 def download_file(filename):
     """Serve downloaded file (for local use only - not used in streaming mode)"""
+    # Only names in the index are served - no guessing at paths
+    if not get_db().execute('SELECT 1 FROM downloads_index WHERE name = ?', (filename,)).fetchone():
+        return jsonify({'error': 'File not found'}), 404
     file_path = DOWNLOADS_DIR / filename
-    if file_path.exists():
-        return send_file(file_path, as_attachment=True)
-    return jsonify({'error': 'File not found'}), 404
+    try:
+        stat = file_path.stat()
+    except FileNotFoundError:
+        # Deleted since it was indexed
+        get_db().execute('DELETE FROM downloads_index WHERE name = ?', (filename,))
+        return jsonify({'error': 'File not found'}), 404
+    return send_file_ranged(
+        file_path,
+        filename,
+        mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+        f'{stat.st_size:x}-{stat.st_mtime_ns:x}'
+    )
+
+def directory_size(path):
+    """Bytes used by the files below path"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+def temp_disk_usage():
+    """Bytes in conversion temp directories, the result cache and the downloads folder.
+    Only the (few, short-lived) temp dirs are walked; the other two come from their tables."""
+    temp_root = Path(tempfile.gettempdir())
+    db = get_db()
+    return {
+        'temp': sum(directory_size(d) for d in temp_root.glob(TEMP_DIR_PREFIX + '*') if d.is_dir()),
+        'result_cache': db.execute('SELECT COALESCE(SUM(size), 0) FROM result_cache WHERE complete = 1').fetchone()[0],
+        'downloads': db.execute('SELECT COALESCE(SUM(size), 0) FROM downloads_index').fetchone()[0],
+    }
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus text exposition: histograms and counters shared by all workers, plus gauges"""
+    lines = []
+    rows = get_db().execute('SELECT name, labels, bucket, count, total FROM histograms ORDER BY name, labels, bucket')
+    series = {}
+    for name, labels, bucket, count, total in rows:
+        series.setdefault(name, {}).setdefault(labels, []).append((bucket, count, total))
+    for name, by_labels in series.items():
+        buckets = METRIC_BUCKETS.get(name)
+        if buckets is None:
+            continue
+        lines.append(f'# HELP {name} {METRIC_HELP[name]}')
+        lines.append(f'# TYPE {name} histogram')
+        for labels, counts in by_labels.items():
+            prefix = labels + ',' if labels else ''
+            per_bucket = dict((bucket, count) for bucket, count, _ in counts)
+            cumulative = 0
+            for i, bound in enumerate(list(buckets) + ['+Inf']):
+                cumulative += per_bucket.get(i, 0)
+                lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {sum(total for _, _, total in counts)}')
+            lines.append(f'{name}_count{{{labels}}} {cumulative}')
+    
+    lines.append('# HELP ytdl_events_total Event counters (cache hits, winning clients, ffmpeg jobs, ...)')
+    lines.append('# TYPE ytdl_events_total counter')
+    for event, value in sorted(read_counters('').items()):
+        lines.append(f'ytdl_events_total{{{metric_labels(event=event)}}} {value}')
+    
+    lines.append('# HELP ytdl_disk_bytes Disk used by downloads, by area')
+    lines.append('# TYPE ytdl_disk_bytes gauge')
+    for area, size in temp_disk_usage().items():
+        lines.append(f'ytdl_disk_bytes{{{metric_labels(area=area)}}} {size}')
+    
+    temp = temp_storage_stats()
+    lines.append('# HELP ytdl_temp_reserved_bytes Disk reserved by downloads in progress (quota: ytdl_temp_quota_bytes)')
+    lines.append('# TYPE ytdl_temp_reserved_bytes gauge')
+    lines.append(f"ytdl_temp_reserved_bytes {temp['reserved_bytes']}")
+    lines.append('# TYPE ytdl_temp_quota_bytes gauge')
+    lines.append(f"ytdl_temp_quota_bytes {temp['quota_bytes']}")
+    
+    # The FFmpeg queue is per worker - label with the pid so scrapes from different workers don't clash
+    gate = ffmpeg_gate.stats()
+    for field in ('active', 'queued'):
+        lines.append(f'# TYPE ytdl_ffmpeg_{field} gauge')
+        lines.append(f'ytdl_ffmpeg_{field}{{{metric_labels(pid=os.getpid())}}} {gate[field]}')
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+# cProfile profiles one request at a time per process
+profile_lock = threading.Lock()
+
+def should_profile(environ):
+    """Whether to run this request under cProfile (see PROFILE_DIR)"""
+    if not PROFILE_DIR:
+        return False
+    if PROFILE_TOKEN and environ.get('HTTP_X_PROFILE') == PROFILE_TOKEN:
+        return True
+    return random.random() < PROFILE_SAMPLE_RATE
+
+class MeteredBody:
+    """Response body wrapper timing the first byte and the whole transfer of one response"""
+    
+    def __init__(self, body, endpoint, started, profiler):
+        self.body = body
+        self.endpoint = endpoint
+        self.started = started
+        self.profiler = profiler
+        self.sent = 0
+        self.first_byte = None
+    
+    def __iter__(self):
+        for chunk in self.body:
+            if chunk and self.first_byte is None:
+                self.first_byte = time.perf_counter()
+                observe('ytdl_response_ttfb_seconds', self.first_byte - self.started, endpoint=self.endpoint)
+            self.sent += len(chunk)
+            yield chunk
+    
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            elapsed = time.perf_counter() - self.started
+            observe('ytdl_response_seconds', elapsed, endpoint=self.endpoint)
+            # Throughput is only meaningful for bodies that took a while
+            if self.first_byte is not None and self.sent >= STREAM_CHUNK_SIZE:
+                observe('ytdl_response_bytes_per_second', self.sent / max(elapsed, 1e-6), endpoint=self.endpoint)
+            if self.profiler:
+                finish_profile(self.profiler, self.endpoint)
+
+def finish_profile(profiler, endpoint):
+    """Stop a request's profiler and write its stats to PROFILE_DIR"""
+    try:
+        profiler.disable()
+        Path(PROFILE_DIR).mkdir(parents=True, exist_ok=True)
+        profiler.dump_stats(str(Path(PROFILE_DIR) / f'{time.time():.3f}-{os.getpid()}-{endpoint}.prof'))
+    finally:
+        profile_lock.release()
+
+class MetricsMiddleware:
+    """WSGI wrapper recording TTFB, duration and throughput per endpoint, and running the profiler"""
+    
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+    
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        try:
+            endpoint = app.url_map.bind_to_environ(environ).match()[0]
+        except Exception:
+            endpoint = 'unmatched'
+        if endpoint in ('static', 'metrics'):
+            return self.wsgi_app(environ, start_response)
+        
+        profiler = None
+        if should_profile(environ) and profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            body = self.wsgi_app(environ, start_response)
+        except BaseException:
+            if profiler:
+                finish_profile(profiler, endpoint)
+            raise
+        if hasattr(body, 'filelike'):
+            # wsgi.file_wrapper body - wrapping it would stop the server from using sendfile()
+            observe('ytdl_response_ttfb_seconds', time.perf_counter() - started, endpoint=endpoint)
+            if profiler:
+                finish_profile(profiler, endpoint)
+            return body
+        return MeteredBody(body, endpoint, started, profiler)
+
+app.wsgi_app = MetricsMiddleware(app.wsgi_app)
 
 if __name__ == '__main__':
+    threading.Thread(target=warm_ydl_pool, daemon=True).start()
+    threading.Thread(target=temp_reaper, daemon=True).start()
+    threading.Thread(target=downloads_indexer, daemon=True).start()
     # Disable debug mode in production (Docker)
     debug_mode = os.environ.get('FLASK_ENV') != 'production'
     # Use PORT environment variable if set (for cloud hosting)
@@ -0,0 +1,218 @@
+"""Local stand-in for YouTube used by the benchmark.
+
+Serves player responses for http://fake.youtube.test/watch?v=<id> URLs (through
+the yt-dlp plugin in bench/yt_dlp_plugins) and synthetic media files with Range
+support. Player clients can be failed or slowed down individually:
+
+    python bench/fake_youtube.py --port 8900 --fail android_vr=bot --delay web=1.5
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+# Error text per failure kind - worded like yt-dlp's, so app.py classifies them the same way
+FAILURES = {
+    'bot': "Sign in to confirm you're not a bot. This helps protect our community.",
+    'login': 'Login required to view this video.',
+    'unavailable': 'Video unavailable. This video has been removed by the uploader.',
+    'error': 'Unable to download API page: Remote end closed connection without response',
+}
+
+CONTENT_TYPES = {'.mp4': 'video/mp4', '.m4a': 'audio/mp4', '.webm': 'audio/webm'}
+
+
+def parse_size(value):
+    """'20M' -> 20971520"""
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([KMG]?)', value.upper())
+    if not match:
+        raise argparse.ArgumentTypeError(f'invalid size: {value}')
+    return int(float(match.group(1)) * 1024 ** ' KMG'.index(match.group(2) or ' '))
+
+
+def parse_client_map(items, convert):
+    """['android_vr=bot', 'web=1.5'] -> {'android_vr': convert('bot'), ...}"""
+    result = {}
+    for item in items or []:
+        client, _, value = item.partition('=')
+        result[client] = convert(value)
+    return result
+
+
+def write_random(path, size):
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            chunk = os.urandom(min(remaining, 1 << 20))
+            f.write(chunk)
+            remaining -= len(chunk)
+
+
+def generate_media(media_dir, video_size, audio_seconds):
+    """Create the served files. Audio is real (decodable) when ffmpeg is available, so
+    conversions do actual work; the video file is random bytes of the requested size."""
+    write_random(media_dir / 'video.mp4', video_size)
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg:
+        source = ['-f', 'lavfi', '-i', f'sine=frequency=440:duration={audio_seconds}']
+        subprocess.run([ffmpeg, '-v', 'error', '-y', *source, '-c:a', 'libopus', '-b:a', '128k',
+                        str(media_dir / 'audio.webm')], check=True)
+        subprocess.run([ffmpeg, '-v', 'error', '-y', *source, '-c:a', 'aac', '-b:a', '128k',
+                        '-movflags', '+faststart', str(media_dir / 'audio.m4a')], check=True)
+    else:
+        # 128 kbit/s worth of bytes - downloadable, but not convertible
+        write_random(media_dir / 'audio.webm', audio_seconds * 16000)
+        write_random(media_dir / 'audio.m4a', audio_seconds * 16000)
+
+
+def player_response(base_url, media_dir, video_id, audio_seconds):
+    """Info dict in the shape yt-dlp's YouTube extractor returns (only what app.py uses)"""
+    def fmt(format_id, name, **fields):
+        return dict(
+            format_id=format_id,
+            url=f'{base_url}/media/{name}?v={video_id}',
+            protocol='http' if base_url.startswith('http:') else 'https',
+            filesize=(media_dir / name).stat().st_size,
+            **fields,
+        )
+
+    return {
+        'id': video_id,
+        'title': f'Benchmark video {video_id}',
+        'duration': audio_seconds,
+        'uploader': 'bench',
+        'view_count': 0,
+        'thumbnail': f'{base_url}/thumbnail.jpg',
+        'formats': [
+            fmt('140', 'audio.m4a', ext='m4a', acodec='mp4a.40.2', vcodec='none', abr=128),
+            fmt('251', 'audio.webm', ext='webm', acodec='opus', vcodec='none', abr=130),
+            fmt('18', 'video.mp4', ext='mp4', acodec='mp4a.40.2', vcodec='avc1.42001E',
+                width=640, height=360, tbr=500),
+        ],
+    }
+
+
+def make_handler(args, media_dir):
+    failures = parse_client_map(args.fail, FAILURES.__getitem__)
+    delays = parse_client_map(args.delay, float)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *_):
+            pass
+
+        def send_json(self, data):
+            body = json.dumps(data).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path == '/player':
+                self.player(parse_qs(url.query))
+            elif url.path.startswith('/media/'):
+                self.media(media_dir / Path(url.path).name)
+            else:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+        def player(self, query):
+            # Like yt-dlp, the listed clients are tried in order until one answers
+            error = None
+            for client in query.get('client', ['default'])[0].split(','):
+                time.sleep(delays.get(client, 0))
+                error = failures.get(client)
+                if error is None:
+                    break
+            if error:
+                self.send_json({'error': error})
+            else:
+                base_url = f'http://{self.headers["Host"]}'
+                self.send_json(player_response(base_url, media_dir, query['v'][0], args.audio_seconds))
+
+        def media(self, path):
+            if not path.is_file():
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            size = path.stat().st_size
+            start, end = 0, size - 1
+            match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+            if match:
+                start = int(match.group(1))
+                end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPES.get(path.suffix, 'application/octet-stream'))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            with open(path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                try:
+                    while remaining > 0:
+                        chunk = f.read(min(65536, remaining))
+                        self.wfile.write(chunk)
+                        remaining -= len(chunk)
+                        if args.rate:
+                            # Per-connection bandwidth limit
+                            time.sleep(len(chunk) / args.rate)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+    return Handler
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--video-size', type=parse_size, default=parse_size('20M'),
+                        help='size of the video format (e.g. 500K, 20M)')
+    parser.add_argument('--audio-seconds', type=int, default=60, help='length of the audio formats')
+    parser.add_argument('--rate', type=parse_size, default=0,
+                        help='bytes/s per media connection (0 = unlimited)')
+    parser.add_argument('--fail', action='append', metavar='CLIENT=KIND',
+                        help=f'fail a player client; KIND is one of {", ".join(FAILURES)} '
+                             '(use "default" for requests without player_client)')
+    parser.add_argument('--delay', action='append', metavar='CLIENT=SECONDS',
+                        help='slow down a player client')
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    media_dir = Path(tempfile.mkdtemp(prefix='fake-youtube-'))
+    # Clean up the media when the benchmark stops us
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        generate_media(media_dir, args.video_size, args.audio_seconds)
+        server = ThreadingHTTPServer(('127.0.0.1', args.port), make_handler(args, media_dir))
+        server.daemon_threads = True
+        print(f'fake YouTube listening on http://127.0.0.1:{args.port}', file=sys.stderr, flush=True)
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutil.rmtree(media_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
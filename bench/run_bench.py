@@ -0,0 +1,348 @@
+"""Offline benchmark: drives /api/info and /api/download through gunicorn against a
+local fake YouTube (bench/fake_youtube.py), without touching the network.
+
+Each scenario starts a fresh fake server, gunicorn and state database, then reports
+requests/s, time to first byte, p50/p99 latency, peak RSS of the gunicorn process
+tree and the temp-disk high-water mark. The fallback scenarios make player clients
+fail, so changes to the retry logic can be compared by number:
+
+    python bench/run_bench.py --requests 50 --concurrency 8
+    python bench/run_bench.py --scenario first-client-fails --scenario all-fail --json out.json
+"""
+import argparse
+import http.client
+import json
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+REPO_DIR = BENCH_DIR.parent
+
+# Clients app.py tries without cookies; 'default' is the config without player_client
+APP_CLIENTS = ('android_vr', 'web', 'web_safari', 'mweb', 'default')
+
+# Extra fake_youtube.py arguments per scenario
+SCENARIOS = {
+    'baseline': [],
+    # android_vr is first in app.py's order - the next config (android_vr,web,...) succeeds via web
+    'first-client-fails': ['--fail', 'android_vr=bot'],
+    'slow-first-client': ['--delay', 'android_vr=4'],
+    'all-fail': [arg for client in APP_CLIENTS for arg in ('--fail', f'{client}=error')],
+    'permanent': [arg for client in APP_CLIENTS for arg in ('--fail', f'{client}=unavailable')],
+}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for_port(port, proc, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'{proc.args[1]} exited with {proc.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'nothing listening on port {port} after {timeout}s')
+
+
+def process_tree(root_pid):
+    """root_pid and all its descendants (gunicorn workers, ffmpeg, pool processes)"""
+    children = {}
+    for stat in Path('/proc').glob('[0-9]*/stat'):
+        try:
+            fields = stat.read_text().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        children.setdefault(int(fields[1]), []).append(int(stat.parent.name))
+    tree, todo = [], [root_pid]
+    while todo:
+        pid = todo.pop()
+        tree.append(pid)
+        todo.extend(children.get(pid, []))
+    return tree
+
+
+def rss_bytes(pids):
+    total = 0
+    for pid in pids:
+        try:
+            for line in Path(f'/proc/{pid}/status').read_text().splitlines():
+                if line.startswith('VmRSS:'):
+                    total += int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return total
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class Sampler(threading.Thread):
+    """Tracks peak RSS of the server process tree and peak disk use of its temp dirs"""
+
+    def __init__(self, root_pid, dirs, interval=0.1):
+        super().__init__(daemon=True)
+        self.root_pid = root_pid
+        self.dirs = dirs
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak_rss = max(self.peak_rss, rss_bytes(process_tree(self.root_pid)))
+            self.peak_disk = max(self.peak_disk, sum(directory_size(d) for d in self.dirs))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def timed_post(port, path, payload, timeout):
+    """POST JSON and read the whole body. Returns (status, ttfb, total seconds, bytes, body head)."""
+    body = json.dumps(payload).encode()
+    started = time.perf_counter()
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        conn.request('POST', path, body, {'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        first = response.read(1)
+        ttfb = time.perf_counter() - started
+        head = first + response.read(65535)
+        size = len(head)
+        while True:
+            chunk = response.read(65536)
+            if not chunk:
+                break
+            size += len(chunk)
+        return response.status, ttfb, time.perf_counter() - started, size, head
+    except (OSError, http.client.HTTPException) as e:
+        return 0, None, time.perf_counter() - started, 0, str(e).encode()
+    finally:
+        conn.close()
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summarize(results, elapsed):
+    ok = [r for r in results if r[0] == 200]
+    ttfbs = [r[1] for r in ok if r[1] is not None]
+    latencies = [r[2] for r in ok]
+    return {
+        'requests': len(results),
+        'ok': len(ok),
+        'errors': {str(status): sum(1 for r in results if r[0] == status)
+                   for status in sorted({r[0] for r in results if r[0] != 200})},
+        'requests_per_second': round(len(results) / elapsed, 2) if elapsed else None,
+        'ttfb_p50': percentile(ttfbs, 50),
+        'ttfb_p99': percentile(ttfbs, 99),
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'bytes': sum(r[3] for r in ok),
+    }
+
+
+def run_phase(port, path, payloads, concurrency, timeout):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda payload: timed_post(port, path, payload, timeout), payloads))
+    return results, time.perf_counter() - started
+
+
+def scrape_attempts(port):
+    """Client/format attempts per download request and attempt outcomes, from /metrics"""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    try:
+        conn.request('GET', '/metrics')
+        text = conn.getresponse().read().decode()
+    finally:
+        conn.close()
+    attempts_sum = attempts_count = 0.0
+    outcomes = {}
+    for line in text.splitlines():
+        match = re.match(r'(\w+)\{(.*)\} (\S+)$', line)
+        if not match:
+            continue
+        name, labels, value = match.group(1), dict(re.findall(r'(\w+)="([^"]*)"', match.group(2))), float(match.group(3))
+        if name == 'ytdl_download_attempts_sum':
+            attempts_sum += value
+        elif name == 'ytdl_download_attempts_count':
+            attempts_count += value
+        elif name == 'ytdl_attempt_seconds_count':
+            key = f'{labels.get("phase")}:{labels.get("outcome")}'
+            outcomes[key] = outcomes.get(key, 0) + int(value)
+    return {
+        'attempts_per_download': round(attempts_sum / attempts_count, 2) if attempts_count else None,
+        'attempt_outcomes': outcomes,
+    }
+
+
+def run_scenario(name, args):
+    work_dir = Path(tempfile.mkdtemp(prefix=f'bench-{name}-'))
+    temp_dir = work_dir / 'tmp'
+    cache_dir = work_dir / 'cache'
+    temp_dir.mkdir()
+    fake_port, app_port = free_port(), free_port()
+
+    fake = subprocess.Popen([
+        sys.executable, str(BENCH_DIR / 'fake_youtube.py'), '--port', str(fake_port),
+        '--video-size', str(args.video_size), '--audio-seconds', str(args.audio_seconds),
+        '--rate', str(args.rate), *SCENARIOS[name],
+    ])
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join(filter(None, [str(BENCH_DIR), os.environ.get('PYTHONPATH')])),
+        FAKE_YOUTUBE_SERVER=f'http://127.0.0.1:{fake_port}',
+        STATE_DB=str(work_dir / 'state.sqlite3'),
+        RESULT_CACHE_DIR=str(cache_dir),
+        TMPDIR=str(temp_dir),
+        WEB_CONCURRENCY=str(args.workers),
+    )
+    server = None
+    try:
+        wait_for_port(fake_port, fake)
+        server = subprocess.Popen([
+            # The config is passed explicitly - gunicorn only finds it on its own in the working
+            # directory, and its post_fork hooks (pool warm-up, reaper, indexer) are part of what we measure
+            sys.executable, '-m', 'gunicorn', '--config', str(REPO_DIR / 'gunicorn.conf.py'),
+            '--bind', f'127.0.0.1:{app_port}',
+            '--workers', str(args.workers), '--threads', str(args.threads), '--timeout', '300',
+            '--chdir', str(REPO_DIR), '--log-level', 'warning', 'app:app',
+        ], env=env, stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+        wait_for_port(app_port, server)
+
+        sampler = Sampler(server.pid, [temp_dir, cache_dir])
+        sampler.start()
+        urls = [f'http://fake.youtube.test/watch?v=bench{i % args.distinct}' for i in range(args.requests)]
+        report = {'scenario': name}
+
+        tokens = {}
+        if 'info' in args.phases:
+            results, elapsed = run_phase(app_port, '/api/info', [{'url': url} for url in urls],
+                                         args.concurrency, args.timeout)
+            for i, (url, result) in enumerate(zip(urls, results)):
+                if result[0] == 200:
+                    data = json.loads(result[4])
+                    tokens[url] = data.get('token')
+                    if 'error' in data:
+                        # /api/info reports extraction failures in a 200 response
+                        results[i] = ('error', *result[1:])
+            report['info'] = summarize(results, elapsed)
+
+        if 'download' in args.phases:
+            payloads = [{
+                'url': url,
+                'format': args.format,
+                'quality': args.quality,
+                'audio_format': args.audio_format,
+                # Like the web UI, reuse the /api/info extraction when there was one
+                'token': None if args.no_token else tokens.get(url),
+            } for url in urls]
+            results, elapsed = run_phase(app_port, '/api/download', payloads, args.concurrency, args.timeout)
+            report['download'] = summarize(results, elapsed)
+
+        sampler.stop()
+        report['peak_rss_mb'] = round(sampler.peak_rss / 2 ** 20, 1)
+        report['peak_temp_disk_mb'] = round(sampler.peak_disk / 2 ** 20, 1)
+        report.update(scrape_attempts(app_port))
+        return report
+    finally:
+        for proc in (server, fake):
+            if proc and proc.poll() is None:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=15)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def fmt_seconds(value):
+    return '-' if value is None else f'{value * 1000:.0f}ms'
+
+
+def print_report(reports):
+    header = f'{"scenario":<20} {"phase":<9} {"ok/total":>9} {"req/s":>7} {"ttfb p50":>9} {"ttfb p99":>9} ' \
+             f'{"p50":>9} {"p99":>9}'
+    print(header)
+    print('-' * len(header))
+    for report in reports:
+        for phase in ('info', 'download'):
+            stats = report.get(phase)
+            if not stats:
+                continue
+            print(f'{report["scenario"]:<20} {phase:<9} {stats["ok"]:>4}/{stats["requests"]:<4} '
+                  f'{stats["requests_per_second"]:>7} {fmt_seconds(stats["ttfb_p50"]):>9} '
+                  f'{fmt_seconds(stats["ttfb_p99"]):>9} {fmt_seconds(stats["latency_p50"]):>9} '
+                  f'{fmt_seconds(stats["latency_p99"]):>9}')
+        print(f'{"":<20} peak RSS {report["peak_rss_mb"]} MB, temp disk high-water {report["peak_temp_disk_mb"]} MB, '
+              f'attempts/download {report["attempts_per_download"]}')
+        if report['attempt_outcomes']:
+            print(f'{"":<20} attempts: ' + ', '.join(f'{k}={v}' for k, v in sorted(report['attempt_outcomes'].items())))
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help='scenario to run (repeatable, default: all)')
+    parser.add_argument('--requests', type=int, default=40, help='requests per phase')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--distinct', type=int, default=10,
+                        help='distinct videos requested (fewer than --requests exercises the caches)')
+    parser.add_argument('--phases', default='info,download', help='comma-separated: info, download')
+    parser.add_argument('--format', default='video', choices=('video', 'audio'))
+    parser.add_argument('--quality', default='best')
+    parser.add_argument('--audio-format', default='mp3')
+    parser.add_argument('--no-token', action='store_true', help="don't pass /api/info tokens to /api/download")
+    parser.add_argument('--video-size', default='20M', help='fake video size (e.g. 500K, 20M)')
+    parser.add_argument('--audio-seconds', type=int, default=60)
+    parser.add_argument('--rate', default='0', help='fake origin bandwidth per connection in bytes/s (e.g. 5M)')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--threads', type=int, default=2, help='gunicorn threads per worker')
+    parser.add_argument('--timeout', type=float, default=300, help='per-request client timeout (seconds)')
+    parser.add_argument('--json', metavar='FILE', help='also write the results as JSON')
+    parser.add_argument('--verbose', action='store_true', help='show gunicorn output')
+    return parser
+
+
+def main():
+    args = build_parser().parse_args()
+    args.phases = set(args.phases.split(','))
+    reports = [run_scenario(name, args) for name in args.scenario or SCENARIOS]
+    print_report(reports)
+    if args.json:
+        Path(args.json).write_text(json.dumps(reports, indent=2))
+
+
+if __name__ == '__main__':
+    main()
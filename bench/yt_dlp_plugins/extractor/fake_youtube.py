@@ -0,0 +1,41 @@
+"""yt-dlp extractors for the benchmark's fake YouTube (bench/fake_youtube.py).
+
+Loaded as a yt-dlp plugin when bench/ is on PYTHONPATH. It reads the same
+youtube:player_client extractor args app.py sets, so the server can fail or
+slow down individual player clients.
+"""
+import os
+from urllib.parse import parse_qs, urlparse
+
+from yt_dlp.extractor.common import InfoExtractor
+from yt_dlp.utils import ExtractorError
+
+
+class FakeYouTubeIE(InfoExtractor):
+    IE_NAME = 'fakeyoutube'
+    _VALID_URL = r'https?://fake\.youtube\.test/watch\?v=(?P<id>[\w-]+)'
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        server = os.environ.get('FAKE_YOUTUBE_SERVER', 'http://127.0.0.1:8900')
+        clients = self._configuration_arg('player_client', ['default'], ie_key='youtube')
+        data = self._download_json(
+            f'{server}/player', video_id, query={'v': video_id, 'client': ','.join(clients)})
+        if 'error' in data:
+            raise ExtractorError(data['error'], expected=True)
+        return data
+
+
+class FakeYouTubePlaylistIE(InfoExtractor):
+    """http://fake.youtube.test/playlist?list=<id>&n=<entries> - n fake videos (default 25)"""
+    IE_NAME = 'fakeyoutube:playlist'
+    _VALID_URL = r'https?://fake\.youtube\.test/playlist\?list=(?P<id>[\w-]+)'
+
+    def _real_extract(self, url):
+        playlist_id = self._match_id(url)
+        count = int(parse_qs(urlparse(url).query).get('n', ['25'])[0])
+        entries = [
+            self.url_result(f'http://fake.youtube.test/watch?v={playlist_id}-{i}', FakeYouTubeIE, f'{playlist_id}-{i}')
+            for i in range(count)
+        ]
+        return self.playlist_result(entries, playlist_id, f'Benchmark playlist {playlist_id}')
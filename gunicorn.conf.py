@@ -0,0 +1,13 @@
+# Gunicorn picks this file up automatically from the working directory
+
+
+def post_fork(server, worker):
+    # Build each worker's pooled YoutubeDL instances in the background, so the first
+    # requests don't pay for extractor and HTTP setup (works with and without --preload)
+    import threading
+    from app import downloads_indexer, temp_reaper, warm_ydl_pool
+    threading.Thread(target=warm_ydl_pool, daemon=True).start()
+    # Cleans up after workers that were killed mid-download
+    threading.Thread(target=temp_reaper, daemon=True).start()
+    # Keeps the /api/downloads index in line with files added or removed by hand
+    threading.Thread(target=downloads_indexer, daemon=True).start()
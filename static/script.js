@@ -7,9 +7,13 @@ const downloadProgress = document.getElementById('downloadProgress');
 const progressBar = document.getElementById('progressBar');
 const progressText = document.getElementById('progressText');
 const refreshBtn = document.getElementById('refreshBtn');
+const serverDownloadBtn = document.getElementById('serverDownloadBtn');
 
 let currentStatusKey = null;
-let statusCheckInterval = null;
+let statusEventSource = null;
+// Extraction token from /api/info - lets the server skip a second extraction on download
+let currentInfoToken = null;
+let currentInfoUrl = null;
 
 function formatDuration(seconds) {
     const hours = Math.floor(seconds / 3600);
@@ -22,6 +26,27 @@ function formatDuration(seconds) {
     return `${minutes}:${secs.toString().padStart(2, '0')}`;
 }
 
+// Exact formats from /api/info's format ladder, listed below the quality presets
+function showFormatLadder(ladder) {
+    const quality = document.getElementById('quality');
+    const previous = quality.querySelector('optgroup');
+    if (previous) previous.remove();
+
+    const video = (ladder || []).filter(f => f.resolution !== 'audio only');
+    if (video.length === 0) return;
+
+    const group = document.createElement('optgroup');
+    group.label = 'Exact formats';
+    video.forEach(f => {
+        const option = document.createElement('option');
+        const size = f.filesize ? ` - ${f.filesize_approx ? '~' : ''}${formatFileSize(f.filesize)}` : '';
+        option.value = `fid:${f.format_id}`;
+        option.textContent = `${f.resolution} ${f.ext} (${f.vcodec})${size}`;
+        group.appendChild(option);
+    });
+    quality.appendChild(group);
+}
+
 function formatFileSize(bytes) {
     if (bytes === 0) return '0 Bytes';
     const k = 1024;
@@ -64,12 +89,16 @@ async function getVideoInfo() {
             return;
         }
 
+        currentInfoToken = data.token || null;
+        currentInfoUrl = url;
+
         // Display video info
         document.getElementById('videoTitle').textContent = data.title;
         document.getElementById('uploader').textContent = data.uploader;
         document.getElementById('duration').textContent = formatDuration(data.duration);
         document.getElementById('views').textContent = data.view_count.toLocaleString();
         document.getElementById('thumbnail').src = data.thumbnail;
+        showFormatLadder(data.format_ladder);
 
         videoInfo.classList.remove('hidden');
     } catch (error) {
@@ -80,10 +109,33 @@ async function getVideoInfo() {
     }
 }
 
-async function startDownload() {
+// Download options from the form, as /api/download-token and /api/jobs take them
+function downloadOptions() {
     const url = urlInput.value.trim();
     const format = document.querySelector('input[name="format"]:checked').value;
-    const quality = document.getElementById('quality').value;
+    let quality = document.getElementById('quality').value;
+    let formatId = null;
+
+    // An exact format from the ladder downloads on the first attempt
+    if (format === 'video' && quality.startsWith('fid:') && url === currentInfoUrl) {
+        formatId = quality.slice(4);
+        quality = 'best';
+    } else if (quality.startsWith('fid:')) {
+        quality = 'best';
+    }
+
+    return {
+        url,
+        format,
+        quality,
+        audio_format: document.getElementById('audioFormat').value,
+        format_id: formatId,
+    };
+}
+
+async function startDownload() {
+    const options = downloadOptions();
+    const url = options.url;
 
     if (!url) {
         showError('Please enter a YouTube URL');
@@ -98,51 +150,41 @@ async function startDownload() {
     progressText.textContent = 'Starting download... This may take a moment.';
 
     try {
-        // Stream download directly to user's browser
-        const response = await fetch('/api/download', {
+        // Get a short-lived download link, then let the browser fetch it natively:
+        // the file streams straight to disk, with the browser's own progress and resume
+        const response = await fetch('/api/download-token', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
             },
-            body: JSON.stringify({ url, format, quality }),
+            body: JSON.stringify({
+                ...options,
+                token: url === currentInfoUrl ? currentInfoToken : null,
+            }),
         });
 
-        if (!response.ok) {
-            const errorData = await response.json();
-            throw new Error(errorData.error || 'Download failed');
-        }
-
-        // Get filename from Content-Disposition header
-        const contentDisposition = response.headers.get('Content-Disposition');
-        let filename = 'video.mp4';
-        if (contentDisposition) {
-            const filenameMatch = contentDisposition.match(/filename="(.+)"/);
-            if (filenameMatch) {
-                filename = filenameMatch[1];
-            }
+        const data = await response.json();
+        if (!response.ok || data.error) {
+            throw new Error(data.error || 'Download failed');
         }
 
-        // Create blob and trigger download
-        const blob = await response.blob();
-        const downloadUrl = window.URL.createObjectURL(blob);
         const a = document.createElement('a');
-        a.href = downloadUrl;
-        a.download = filename;
+        a.href = data.download_url;
+        a.download = '';
         document.body.appendChild(a);
         a.click();
         document.body.removeChild(a);
-        window.URL.revokeObjectURL(downloadUrl);
 
         // Update UI
         progressBar.style.width = '100%';
-        progressText.textContent = 'Download complete!';
+        progressText.textContent = "Download started - see your browser's downloads for progress.";
         downloadBtn.disabled = false;
         downloadBtn.textContent = 'Download';
         
         // Hide progress after a moment
         setTimeout(() => {
             downloadProgress.classList.add('hidden');
-        }, 2000);
+        }, 4000);
         
     } catch (error) {
         showError('Download failed: ' + error.message);
@@ -152,30 +194,122 @@ async function startDownload() {
     }
 }
 
-// Status checking not needed for streaming downloads
-// Keeping function for backward compatibility but it won't be called
-function startStatusCheck() {
-    // Not used in streaming mode
-}
+// Download on the server as a background job and follow its progress live
+async function startServerDownload() {
+    const options = downloadOptions();
+    if (!options.url) {
+        showError('Please enter a YouTube URL');
+        return;
+    }
+
+    hideError();
+    serverDownloadBtn.disabled = true;
+    progressBar.style.width = '0%';
+    progressText.textContent = 'Queued...';
+    downloadProgress.classList.remove('hidden');
 
-async function loadDownloads() {
     try {
-        const response = await fetch('/api/downloads');
+        const response = await fetch('/api/jobs', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(options),
+        });
         const data = await response.json();
-        const filesList = document.getElementById('filesList');
+        if (!response.ok || data.error) {
+            throw new Error(data.error || 'Download failed');
+        }
+        startStatusCheck(data.status_key);
+    } catch (error) {
+        showError('Download failed: ' + error.message);
+        downloadProgress.classList.add('hidden');
+    } finally {
+        serverDownloadBtn.disabled = false;
+    }
+}
 
-        if (data.files.length === 0) {
-            filesList.innerHTML = '<p style="color: #718096; padding: 20px; text-align: center;">No downloads yet</p>';
-            return;
+function formatSpeed(bytesPerSecond) {
+    if (!bytesPerSecond) return '';
+    return formatFileSize(Math.round(bytesPerSecond)) + '/s';
+}
+
+// Follow a background job (/api/jobs) through Server-Sent Events - no polling.
+// The streaming download button doesn't need this; it's used by "Save on Server".
+function startStatusCheck(statusKey) {
+    if (statusEventSource) {
+        statusEventSource.close();
+    }
+    currentStatusKey = statusKey;
+    downloadProgress.classList.remove('hidden');
+    statusEventSource = new EventSource(`/api/jobs/${encodeURIComponent(statusKey)}/events`);
+
+    statusEventSource.onmessage = (event) => {
+        const status = JSON.parse(event.data);
+        progressBar.style.width = `${status.progress}%`;
+
+        if (status.status === 'completed') {
+            progressText.textContent = 'Download complete! The file is listed below.';
+            statusEventSource.close();
+            document.getElementById('downloadsList').style.display = 'block';
+            loadDownloads();
+        } else if (status.status === 'error') {
+            showError(status.error || 'Download failed');
+            downloadProgress.classList.add('hidden');
+            statusEventSource.close();
+        } else if (status.status === 'processing') {
+            progressText.textContent = 'Processing...';
+        } else {
+            const details = [formatSpeed(status.speed)];
+            if (status.eta) details.push(`${formatDuration(status.eta)} left`);
+            progressText.textContent = `${status.progress}% ${details.filter(Boolean).join(' - ')}`;
         }
+    };
+}
 
-        filesList.innerHTML = data.files.map(file => `
+// Cursor of the next page of /api/downloads (null when everything is shown)
+let downloadsCursor = null;
+
+function renderFileItem(file) {
+    return `
             <div class="file-item">
                 <span class="file-name">${file.name}</span>
                 <span class="file-size">${formatFileSize(file.size)}</span>
                 <a href="/api/download-file/${encodeURIComponent(file.name)}" class="file-download">Download</a>
             </div>
-        `).join('');
+        `;
+}
+
+async function loadDownloads(append = false) {
+    try {
+        const query = append && downloadsCursor ? `?cursor=${encodeURIComponent(downloadsCursor)}` : '';
+        const response = await fetch(`/api/downloads${query}`);
+        const data = await response.json();
+        const filesList = document.getElementById('filesList');
+
+        if (!append && data.files.length === 0) {
+            filesList.innerHTML = '<p style="color: #718096; padding: 20px; text-align: center;">No downloads yet</p>';
+            return;
+        }
+
+        const previous = filesList.querySelector('.load-more');
+        if (previous) previous.remove();
+        const items = data.files.map(renderFileItem).join('');
+        if (append) {
+            filesList.insertAdjacentHTML('beforeend', items);
+        } else {
+            filesList.innerHTML = items;
+        }
+
+        // Newest first, one page at a time
+        downloadsCursor = data.next_cursor;
+        if (downloadsCursor) {
+            const more = document.createElement('button');
+            more.className = 'btn btn-secondary load-more';
+            more.textContent = 'Load more';
+            more.addEventListener('click', () => loadDownloads(true));
+            filesList.appendChild(more);
+        }
     } catch (error) {
         console.error('Error loading downloads:', error);
     }
@@ -193,7 +327,8 @@ function hideError() {
 // Event listeners
 infoBtn.addEventListener('click', getVideoInfo);
 downloadBtn.addEventListener('click', startDownload);
-refreshBtn.addEventListener('click', loadDownloads);
+serverDownloadBtn.addEventListener('click', startServerDownload);
+refreshBtn.addEventListener('click', () => loadDownloads());
 
 urlInput.addEventListener('keypress', (e) => {
     if (e.key === 'Enter') {
@@ -205,15 +340,18 @@ urlInput.addEventListener('keypress', (e) => {
 document.querySelectorAll('input[name="format"]').forEach(radio => {
     radio.addEventListener('change', (e) => {
         const qualityGroup = document.getElementById('qualityGroup');
+        const audioFormatGroup = document.getElementById('audioFormatGroup');
         if (e.target.value === 'audio') {
             qualityGroup.style.display = 'none';
+            audioFormatGroup.style.display = 'flex';
         } else {
             qualityGroup.style.display = 'flex';
+            audioFormatGroup.style.display = 'none';
         }
     });
 });
 
-// Note: Downloads list is kept for local use, but streaming mode doesn't store files
-// Uncomment the line below if you want to show downloads list (for local development)
+// The downloads list only appears once a "Save on Server" job has finished
+// Uncomment the line below if you want to show it from the start (for local development)
 // loadDownloads();
 
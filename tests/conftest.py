@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# app.py reads its configuration at import time - point its state at a scratch directory
+STATE_DIR = Path(tempfile.mkdtemp(prefix='yt-downloader-tests-'))
+os.environ['STATE_DB'] = str(STATE_DIR / 'state.sqlite3')
+os.environ['RESULT_CACHE_DIR'] = str(STATE_DIR / 'cache')
+os.environ['COOKIES_DIR'] = str(STATE_DIR / 'cookies')
+os.environ['DOWNLOAD_TOKEN_SECRET'] = 'test-secret'
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    return app_module
+
+
+@pytest.fixture
+def client():
+    app_module.app.config['TESTING'] = True
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def downloads_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, 'DOWNLOADS_DIR', tmp_path)
+    return tmp_path
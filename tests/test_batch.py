@@ -0,0 +1,25 @@
+import pytest
+
+
+@pytest.mark.parametrize('body', [
+    {'urls': 'https://youtu.be/abc'},
+    {'urls': ['https://youtu.be/abc', 5]},
+    {'urls': [{'url': 'https://youtu.be/abc'}]},
+    {'url': ['https://youtu.be/abc']},
+    {'urls': []},
+])
+def test_batch_rejects_malformed_urls(client, body):
+    response = client.post('/api/batch', json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+def test_batch_caps_url_count(app, client, monkeypatch):
+    monkeypatch.setattr(app, 'BATCH_MAX_ENTRIES', 2)
+    response = client.post('/api/batch', json={'urls': ['https://youtu.be/a', 'https://youtu.be/b', 'https://youtu.be/c']})
+    assert response.status_code == 400
+
+
+def test_batch_rejects_invalid_download_options(client):
+    response = client.post('/api/batch', json={'urls': ['https://youtu.be/abc'], 'download': {'format': 'best'}})
+    assert response.status_code == 400
@@ -0,0 +1,42 @@
+import base64
+import json
+
+import pytest
+
+
+def make_cursor(value):
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).rstrip(b'=').decode()
+
+
+@pytest.mark.parametrize('sort, after', [
+    ('mtime', [{}, []]),
+    ('mtime', [None, 1]),
+    ('mtime', ['x', 'a.mp4']),
+    ('mtime', [True, 'a.mp4']),
+    ('size', [2 ** 70, 'a.mp4']),
+    ('name', [1, 'a.mp4']),
+    ('name', ['a.mp4', None]),
+    ('mtime', [1]),
+])
+def test_malformed_cursor_is_rejected(client, sort, after):
+    response = client.get('/api/downloads', query_string={'sort': sort, 'cursor': make_cursor(after)})
+    assert response.status_code == 400
+
+
+def test_cursor_pages_through_index(app, client, downloads_dir):
+    for i in range(3):
+        path = downloads_dir / f'page-{i}.mp4'
+        path.write_bytes(b'x' * (i + 1))
+        app.index_download(path)
+
+    names, cursor = [], None
+    while True:
+        query = {'sort': 'name', 'order': 'asc', 'limit': 1, 'q': 'page-'}
+        if cursor:
+            query['cursor'] = cursor
+        body = client.get('/api/downloads', query_string=query).get_json()
+        names += [f['name'] for f in body['files']]
+        cursor = body['next_cursor']
+        if not cursor:
+            break
+    assert names == ['page-0.mp4', 'page-1.mp4', 'page-2.mp4']
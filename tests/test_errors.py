@@ -0,0 +1,34 @@
+import pytest
+from yt_dlp import utils as yt_dlp_utils
+
+PRIVATE = 'ERROR: [youtube] abc: Video unavailable. This video is private'
+
+
+def test_private_video_is_auth_required(app):
+    assert app.classify_error(PRIVATE) == app.ERROR_AUTH_REQUIRED
+    assert app.classify_error('ERROR: [youtube] abc: Private video. Sign in if you have access') == app.ERROR_AUTH_REQUIRED
+    assert app.classify_error('ERROR: [youtube] abc: Video unavailable. This video has been removed') == app.ERROR_PERMANENT
+
+
+@pytest.mark.parametrize('fanout', [1, 2])
+def test_private_video_reaches_cookie_clients(app, monkeypatch, fanout):
+    """The download order starts with android_vr without cookies - its 'private' answer must not end the chain"""
+    monkeypatch.setattr(app, 'HEDGE_FANOUT', fanout)
+    monkeypatch.setattr(app, 'HEDGE_DELAY', 0.01)
+    configs = app.client_configs_for(True, for_download=True)
+    assert configs[0].get('no_cookies')
+
+    def attempt(config):
+        if config.get('no_cookies'):
+            raise yt_dlp_utils.DownloadError(PRIVATE)
+        return 'info'
+
+    errors = []
+    config, result = app.run_hedged(attempt, configs, errors)
+    assert result == 'info'
+    assert not config.get('no_cookies')
+    assert app.permanent_error_summary(errors) is None
+
+
+def test_media_fetch_404_is_transient(app):
+    assert app.classify_error('ERROR: unable to download video data: HTTP Error 404: Not Found') == app.ERROR_TRANSIENT
@@ -0,0 +1,49 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+
+@pytest.fixture
+def hedging(app, monkeypatch):
+    def configure(pool_size, delay):
+        executor = ThreadPoolExecutor(max_workers=pool_size)
+        monkeypatch.setattr(app, 'hedge_executor', executor)
+        monkeypatch.setattr(app, 'HEDGE_POOL_SIZE', pool_size)
+        monkeypatch.setattr(app, 'HEDGE_FANOUT', 2)
+        monkeypatch.setattr(app, 'HEDGE_DELAY', delay)
+        return executor
+    return configure
+
+
+def test_slow_running_attempt_is_hedged(app, hedging):
+    hedging(pool_size=2, delay=0.1)
+    release = threading.Event()
+
+    def attempt(config):
+        if config == 'slow':
+            release.wait(5)
+            return 'slow'
+        return 'fast'
+
+    started = time.time()
+    try:
+        assert app.run_hedged(attempt, ['slow', 'fast'], []) == ('fast', 'fast')
+    finally:
+        release.set()
+    assert time.time() - started < 2
+
+
+def test_queued_attempt_does_not_trigger_hedge(app, hedging):
+    executor = hedging(pool_size=1, delay=0.05)
+    # Another request's attempt holds the only pool thread for a while
+    executor.submit(time.sleep, 0.4)
+    calls = []
+
+    def attempt(config):
+        calls.append(config)
+        return config
+
+    assert app.run_hedged(attempt, ['first', 'second'], []) == ('first', 'first')
+    assert calls == ['first']
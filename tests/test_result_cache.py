@@ -0,0 +1,28 @@
+def test_serve_result_treats_evicted_row_as_miss(app, tmp_path):
+    path = tmp_path / 'evicted.data'
+    path.write_bytes(b'data')
+    f = open(path, 'rb')
+    with app.app.test_request_context('/api/download', method='POST'):
+        assert app.serve_result('no-such-key', f) is None
+    assert f.closed
+
+
+def test_cached_request_falls_back_when_row_is_gone(app, monkeypatch):
+    key = 'evicted-between-lookups'
+    alias = app.result_alias('https://youtu.be/evicted', 'best', [])
+    app.get_db().execute('INSERT OR REPLACE INTO result_aliases (alias, key, created) VALUES (?, ?, 0)', (alias, key))
+    app.begin_result(key, 'v.mp4', 'mp4', 4)
+    app.get_db().execute('UPDATE result_cache SET complete = 1 WHERE key = ?', (key,))
+    app.result_path(key).write_bytes(b'data')
+    original = app.open_result
+
+    def open_then_evict(k):
+        # evict_results() running in another worker between the lookup and serve_result
+        f = original(k)
+        app.get_db().execute('DELETE FROM result_cache WHERE key = ?', (k,))
+        return f
+
+    monkeypatch.setattr(app, 'open_result', open_then_evict)
+    with app.app.test_request_context('/api/download', method='POST'):
+        assert app.serve_cached_request('https://youtu.be/evicted', 'best', []) is None
+    app.result_path(key).unlink()
@@ -0,0 +1,32 @@
+import re
+
+
+def test_download_file_with_non_ascii_title(app, client, downloads_dir):
+    name = '日本語 "live" 🎵.mp4'
+    path = downloads_dir / name
+    path.write_bytes(b'0123456789')
+    app.index_download(path)
+
+    response = client.get(f'/api/download-file/{name}')
+    assert response.status_code == 200
+    assert response.data == b'0123456789'
+    disposition = response.headers['Content-Disposition']
+    # Must survive HTTP's latin-1 header encoding, with the real name in filename*
+    disposition.encode('latin-1')
+    assert re.search(r'filename="[^"\\]*(\\.[^"\\]*)*"', disposition)
+    assert "filename*=UTF-8''%E6%97%A5%E6%9C%AC%E8%AA%9E%20%22live%22%20%F0%9F%8E%B5.mp4" in disposition
+
+
+def test_ascii_title_keeps_plain_filename(app):
+    assert app.content_disposition('video.mp4') == 'attachment; filename="video.mp4"'
+
+
+def test_head_sends_headers_only(app, client, downloads_dir):
+    path = downloads_dir / 'clip.mp4'
+    path.write_bytes(b'x' * 100)
+    app.index_download(path)
+
+    response = client.head('/api/download-file/clip.mp4')
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == '100'
+    assert response.data == b''
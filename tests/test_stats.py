@@ -0,0 +1,24 @@
+def test_bandwidth_stats_hide_urls_and_keys(app, client):
+    job = app.BandwidthJob('video_123_abcdef', 'job', 'https://youtu.be/secret-video', 1000)
+    try:
+        body = client.get('/api/bandwidth').get_data(as_text=True)
+    finally:
+        job.finish()
+    assert 'secret-video' not in body
+    assert 'video_123_abcdef' not in body
+    assert app.opaque_id('video_123_abcdef') in body
+
+
+def test_cookie_stats_hide_file_paths(app, client, tmp_path, monkeypatch):
+    cookies_dir = tmp_path / 'cookies'
+    cookies_dir.mkdir()
+    (cookies_dir / 'alice.txt').write_text('# Netscape HTTP Cookie File\n')
+    monkeypatch.setattr(app, 'COOKIES_DIR', cookies_dir)
+    monkeypatch.setitem(app.cookie_pool, 'scanned', 0)
+    try:
+        accounts = client.get('/api/cookies/stats').get_json()['accounts']
+    finally:
+        # Rescan with the real COOKIES_DIR next time
+        app.cookie_pool['scanned'] = 0
+    assert accounts
+    assert all('alice' not in account['account'] and '/' not in account['account'] for account in accounts)
@@ -0,0 +1,39 @@
+import pytest
+
+ENDPOINTS = ['/api/download', '/api/download-token', '/api/jobs']
+
+
+@pytest.mark.parametrize('endpoint', ENDPOINTS)
+@pytest.mark.parametrize('field, value', [
+    ('url', ['https://youtu.be/abc']),
+    ('url', 5),
+    ('format', ['video']),
+    ('format', {'a': 1}),
+    ('quality', 720),
+    ('audio_format', ['mp3']),
+    ('audio_format', {'mp3': 1}),
+    ('format_id', ['137+140']),
+    ('format_id', 137),
+    ('token', {'x': 1}),
+])
+def test_non_string_fields_are_rejected(client, endpoint, field, value):
+    body = {'url': 'https://youtu.be/abc', field: value}
+    response = client.post(endpoint, json=body)
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+
+@pytest.mark.parametrize('endpoint', ENDPOINTS)
+def test_non_object_body_is_rejected(client, endpoint):
+    assert client.post(endpoint, json=['https://youtu.be/abc']).status_code == 400
+
+
+@pytest.mark.parametrize('field, value', [
+    ('format', 'best'),
+    ('quality', '1080p'),
+    ('audio_format', 'flac'),
+    ('format_id', '137; rm'),
+])
+def test_unknown_values_are_rejected(client, field, value):
+    response = client.post('/api/download-token', json={'url': 'https://youtu.be/abc', field: value})
+    assert response.status_code == 400